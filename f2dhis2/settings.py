@@ -177,6 +177,102 @@ DHIS2_DATA_VALUE_SET_URL = "http://apps.dhis2.org/demo/api/dataValueSets"
 DHIS2_USERNAME = "admin"
 DHIS2_PASSWORD = "district"
 
+# seconds the parsed field index of a Formhub form stays cached, it is
+# keyed by the form definition so changed forms are parsed again
+FORM_FIELD_INDEX_CACHE_TIMEOUT = 24 * 60 * 60
+
+# number of queued submissions pulled from Formhub with a single query
+FORMHUB_FETCH_CHUNK_SIZE = 50
+
+# Formhub fetches and DHIS2 posts a queue run keeps in flight, runs are
+# sequential with 1
+DATA_QUEUE_CONCURRENCY = 1
+# highest concurrency the process queue page may be asked for
+DATA_QUEUE_MAX_CONCURRENCY = 8
+
+# queue items a worker claims at a time and the seconds its lease on them
+# lasts, expired leases are released by the release_dqueue_leases task
+DATA_QUEUE_CLAIM_SIZE = 200
+DATA_QUEUE_LEASE_TIMEOUT = 600
+
+# failed queue items are retried after DATA_QUEUE_RETRY_DELAY seconds,
+# doubling up to DATA_QUEUE_MAX_RETRY_DELAY, and become dead letters after
+# DATA_QUEUE_MAX_ATTEMPTS attempts
+DATA_QUEUE_RETRY_DELAY = 60
+DATA_QUEUE_MAX_RETRY_DELAY = 6 * 60 * 60
+DATA_QUEUE_MAX_ATTEMPTS = 10
+
+# seconds between the periodic runs that send the items due for another
+# attempt
+DATA_QUEUE_DRAIN_INTERVAL = 60
+
+# Formhub records requested per page when backfilling a form
+BACKFILL_PAGE_SIZE = 1000
+
+# seconds a webhook triggered queue run waits for more submissions of the
+# same service before it starts; the pending run is tracked in the cache,
+# so CACHES should be shared by the web processes, e.g. memcached, or each
+# of them schedules its own run
+DATA_QUEUE_TRIGGER_DELAY = 10
+
+# how data value sets are written for DHIS2: 'template' renders
+# datavalueset.xml, 'stream' writes the same XML while streaming a chunked
+# request body
+DHIS2_SERIALIZER = 'template'
+
+# payload format posted to DHIS2, 'xml' or 'json', and whether request
+# bodies are gzipped
+DHIS2_CODEC = 'xml'
+DHIS2_GZIP = False
+
+# consecutive failed DHIS2 requests after which no requests are made for
+# DHIS2_BREAKER_RESET_TIMEOUT seconds
+DHIS2_BREAKER_THRESHOLD = 5
+DHIS2_BREAKER_RESET_TIMEOUT = 60
+
+# DHIS2 requests per second, None for no limit, and the burst allowed
+DHIS2_RATE_LIMIT = None
+DHIS2_RATE_BURST = None
+
+# bounds of the number of concurrent DHIS2 requests, the limit is halved
+# whenever a request takes longer than DHIS2_LATENCY_TARGET seconds or
+# DHIS2 answers 429 or 503, and slowly grows back otherwise
+DHIS2_CONCURRENCY_MIN = 1
+DHIS2_CONCURRENCY_MAX = 8
+DHIS2_LATENCY_TARGET = 10
+
+# the DHIS2_* options above can be set per DHIS2 instance, keyed by host,
+# e.g. {'apps.dhis2.org': {'CODEC': 'json', 'GZIP': True}}
+DHIS2_TARGETS = {}
+
+# seconds DHIS2 metadata, e.g. data sets being imported, is used without
+# asking DHIS2 whether it changed, and the bytes of metadata kept
+DHIS2_METADATA_CACHE_TTL = 60
+DHIS2_METADATA_CACHE_MAX_SIZE = 50 * 1024 * 1024
+
+# seconds between syncs of imported data sets with DHIS2, only metadata
+# changed since the previous sync is loaded
+DHIS2_METADATA_SYNC_INTERVAL = 60 * 60
+
+# ids looked up per query when importing many rows at once, below the 999
+# parameters sqlite allows in a query
+BULK_LOOKUP_CHUNK_SIZE = 500
+
+# seconds the counters of the metrics view, e.g. DHIS2 responses, are kept
+# in the cache; they are written by the Celery workers and read by the web
+# processes, so CACHES must be shared by both, memcached keeps them up to
+# 30 days
+METRICS_COUNTER_TIMEOUT = 30 * 24 * 60 * 60
+
+# limits of a single dataValueSets POST to DHIS2
+DHIS2_BATCH_MAX_SETS = 100
+DHIS2_BATCH_MAX_BYTES = 1024 * 1024
+
+# idle keep-alive connections kept per Formhub/DHIS2 host, and the seconds
+# an idle connection may be reused for
+HTTP_POOL_SIZE = 4
+HTTP_POOL_IDLE_TIMEOUT = 30
+
 
 try:
     from local_settings import *
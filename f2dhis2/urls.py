@@ -13,6 +13,8 @@ urlpatterns = patterns('',
     url(r'^$', 'main.views.main', name='home'),
     url(r'^(?P<id_string>[^/]+)/post/(?P<uuid>[^/]+)$',
         'main.views.initiate_formhub_request', name='home'),
+    url(r'^(?P<id_string>[^/]+)/post$',
+        'main.views.initiate_formhub_request', name='push'),
     url(r'^dataset-import$',
         'main.views.dataset_import', name='dataset-import'),
     url(r'^datasets$',
@@ -23,6 +25,8 @@ urlpatterns = patterns('',
         'main.views.show_formhub_forms', name='fh-forms'),
     url(r'^process-dqueue$',
         'main.views.process_dataqueue', name='process-queue'),
+    url(r'^metrics$',
+        'main.views.metrics', name='metrics'),
     url(r'^create-dvs',
         'main.views.create_datavalueset', name='create-dvs'),
     url(r'^match-elements',
@@ -0,0 +1,370 @@
+"""
+Local stand-ins for the Formhub data API and DHIS2, and a throughput
+benchmark of the queue processor run against them.
+"""
+import BaseHTTPServer
+import json
+import random
+import socket
+import SocketServer
+import threading
+import time
+from urlparse import parse_qs, urlparse
+
+from django.db import connection
+from django.test.utils import override_settings
+
+from main.models import (DataElement, DataQueue, DataSet, DataValueSet,
+                         FormDataElement, FormhubService)
+from main.utils import DataQueueProcessor, DataValueSetBatch
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                body.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return ''.join(body)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def respond(self, status, content='', content_type='application/json',
+                headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+        if not self.server.keep_alive:
+            # without a Connection: close header, like a server dropping an
+            # idle keep-alive connection
+            self.close_connection = 1
+
+    def handle_one_request(self):
+        started = time.time()
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        if getattr(self, 'command', None):
+            self.server.record_latency(time.time() - started)
+
+    def simulate(self):
+        """
+        waits the server's latency, returns True if the request is to fail
+        """
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.should_fail():
+            self.respond(503, 'Service Unavailable', 'text/plain')
+            return True
+        return False
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves a FakeHandler on a free local port from a background thread.
+    Every request is delayed by latency seconds and answered with a 503 at
+    error_rate, the time taken to answer each request is kept in latencies.
+    Connections are closed after every response unless keep_alive is set.
+    """
+    daemon_threads = True
+    latency = 0
+    error_rate = 0
+    keep_alive = True
+
+    def __init__(self, handler, latency=0, error_rate=0, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.latencies = []
+        self.requests = set()
+        self.lock = threading.Lock()
+        self.base_url = 'http://127.0.0.1:%d' % self.server_address[1]
+        # a short poll interval keeps close() quick
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.requests.add(request)
+        SocketServer.ThreadingMixIn.process_request(
+            self, request, client_address)
+
+    def close_request(self, request):
+        with self.lock:
+            self.requests.discard(request)
+        BaseHTTPServer.HTTPServer.close_request(self, request)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        # ends the threads serving keep-alive connections
+        with self.lock:
+            requests = list(self.requests)
+        for request in requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class FakeDHIS2Handler(FakeHandler):
+    def do_POST(self):
+        body = self.read_body()
+        if self.simulate():
+            return
+        self.server.received.append(
+            (self.headers.get('Content-Type'),
+             self.headers.get('Content-Encoding'), body))
+        content = '<importSummary><status>SUCCESS</status></importSummary>'
+        self.respond(self.server.status, content, 'application/xml')
+
+    def do_GET(self):
+        if self.simulate():
+            return
+        etag, content = self.server.metadata
+        self.server.gets.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == etag:
+            self.respond(304, headers={'ETag': etag})
+            return
+        self.respond(200, content, headers={'ETag': etag})
+
+
+class FakeDHIS2Server(FakeServer):
+    """
+    Accepts every data value set POSTed to url, keeping the
+    (Content-Type, Content-Encoding, body) of each request in received, and
+    answers GETs with the (etag, content) in metadata.
+    """
+
+    def __init__(self, latency=0, error_rate=0, seed=None):
+        FakeServer.__init__(self, FakeDHIS2Handler, latency, error_rate,
+                            seed)
+        self.received = []
+        self.gets = []
+        self.metadata = ('"v1"', '{"id": "ds0"}')
+        self.status = 200
+        self.url = self.base_url + '/api/dataValueSets'
+
+
+class FakeFormhubHandler(FakeHandler):
+    def do_GET(self):
+        if self.simulate():
+            return
+        url = urlparse(self.path)
+        if url.path.endswith('/form.json'):
+            self.respond(200, json.dumps(self.server.form))
+            return
+        params = dict([(name, values[0])
+                       for name, values in parse_qs(url.query).items()])
+        if 'query' in params:
+            uuids = json.loads(params['query'])['_uuid']
+            if isinstance(uuids, dict):
+                uuids = uuids['$in']
+            else:
+                uuids = [uuids]
+        else:
+            start = int(params.get('start', 0))
+            limit = int(params.get('limit', self.server.submissions))
+            uuids = ['uuid%d' % i for i in range(
+                start, min(start + limit, self.server.submissions))]
+        self.respond(200, json.dumps(
+            [self.server.get_record(uuid) for uuid in uuids
+             if self.server.has_record(uuid)]))
+
+
+class FakeFormhubServer(FakeServer):
+    """
+    Serves a form with fields f0, f1, ... and its submissions uuid0,
+    uuid1, ..., below url, through the form.json and data API endpoints
+    """
+    submissions = 0
+    fields = 0
+    org_units = 0
+
+    def __init__(self, submissions=0, fields=10, org_units=100, latency=0,
+                 error_rate=0, seed=None):
+        FakeServer.__init__(self, FakeFormhubHandler, latency, error_rate,
+                            seed)
+        self.submissions = submissions
+        self.fields = fields
+        self.org_units = org_units
+        self.url = self.base_url + '/bob/forms/benchmark'
+        self.form = {
+            'id_string': 'benchmark', 'name': 'benchmark',
+            'children': [{'name': 'f%d' % i, 'type': 'integer'}
+                         for i in range(fields)]}
+
+    def has_record(self, uuid):
+        return uuid.startswith('uuid') and \
+            int(uuid[4:]) < self.submissions
+
+    def get_record(self, uuid):
+        n = int(uuid[4:])
+        record = {'_id': n, '_uuid': uuid, 'period': '2013-01-15',
+                  'location': 'ou%d' % (n % self.org_units)}
+        for i in range(self.fields):
+            record['f%d' % i] = n + i
+        return record
+
+
+def seed_queue(formhub, records, services=1, data_sets=1):
+    """
+    maps `services` copies of the fake form onto `data_sets` data sets and
+    queues `records` of its submissions spread across the services
+    """
+    fhs = []
+    for s in range(services):
+        service = FormhubService.objects.create(
+            id_string='benchmark%d' % s, name='benchmark%d' % s,
+            url='%s%d' % (formhub.url, s), json=json.dumps(formhub.form))
+        fhs.append(service)
+    for d in range(data_sets):
+        ds = DataSet.objects.create(data_set_id='benchmark%d' % d,
+                                    name='Benchmark %d' % d)
+        DataElement.objects.bulk_create([
+            DataElement(data_element_id='ds%dde%d' % (d, i),
+                        name='Element %d' % i, data_set=ds)
+            for i in range(formhub.fields)])
+        elements = list(DataElement.objects.filter(data_set=ds)
+                        .order_by('pk'))
+        for service in fhs:
+            dvs = DataValueSet.objects.create(service=service, data_set=ds)
+            FormDataElement.objects.bulk_create([
+                FormDataElement(data_value_set=dvs, data_element=de,
+                                form_field='f%d' % i)
+                for i, de in enumerate(elements)])
+    DataQueue.objects.bulk_create([
+        DataQueue(service=fhs[i % services], data_id='uuid%d' % i)
+        for i in range(records)])
+
+
+class BenchmarkProcessor(DataQueueProcessor):
+    """
+    Keeps how long each item took from being claimed to being finished
+    """
+    claimed_on = None
+    latencies = None
+
+    def __init__(self, *args, **kwargs):
+        super(BenchmarkProcessor, self).__init__(*args, **kwargs)
+        self.claimed_on = {}
+        self.latencies = []
+
+    def claim_items(self):
+        items = super(BenchmarkProcessor, self).claim_items()
+        now = time.time()
+        for dq in items:
+            self.claimed_on[dq.pk] = now
+        return items
+
+    def finished(self, dq):
+        if dq.pk in self.claimed_on:
+            self.latencies.append(time.time() - self.claimed_on.pop(dq.pk))
+
+    def finish_item(self, dq, failures=None):
+        super(BenchmarkProcessor, self).finish_item(dq, failures)
+        self.finished(dq)
+
+    def retry_item(self, dq, status, message):
+        super(BenchmarkProcessor, self).retry_item(dq, status, message)
+        self.finished(dq)
+
+
+def get_percentile(values, percent):
+    """
+    returns the nearest-rank percentile of values, None if there are none
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def run_benchmark(records=1000, services=1, data_sets=1, latency=0,
+                  error_rate=0, concurrency=1, batch_sets=None, seed=0):
+    """
+    Drains `records` queued submissions through fake Formhub and DHIS2
+    servers answering after `latency` seconds and failing at `error_rate`,
+    with a DataQueueProcessor of the given concurrency.
+
+    Seeds the current database, so it is to be run on a throwaway one.
+    Returns records per second, p50/p99 of the seconds from an item being
+    claimed to it being finished and of the DHIS2 requests, and queries
+    per record, along with the run's summary.
+    """
+    formhub = FakeFormhubServer(records, latency=latency,
+                                error_rate=error_rate, seed=seed)
+    dhis2 = FakeDHIS2Server(latency, error_rate, seed)
+    debug_cursor = connection.use_debug_cursor
+    try:
+        with override_settings(DHIS2_DATA_VALUE_SET_URL=dhis2.url):
+            seed_queue(formhub, records, services, data_sets)
+            batch = None
+            if batch_sets:
+                batch = DataValueSetBatch(max_sets=batch_sets)
+            processor = BenchmarkProcessor(batch=batch,
+                                           concurrency=concurrency)
+            connection.use_debug_cursor = True
+            connection.queries = []
+            started = time.time()
+            summary = processor.run()
+            seconds = time.time() - started
+            queries = len(connection.queries)
+    finally:
+        connection.use_debug_cursor = debug_cursor
+        connection.queries = []
+        formhub.close()
+        dhis2.close()
+    return {
+        'records': records, 'services': services, 'data_sets': data_sets,
+        'latency': latency, 'error_rate': error_rate,
+        'concurrency': concurrency, 'seconds': seconds,
+        'records_per_second': summary['processed'] / seconds,
+        'p50': get_percentile(processor.latencies, 50),
+        'p99': get_percentile(processor.latencies, 99),
+        'dhis2_p50': get_percentile(dhis2.latencies, 50),
+        'dhis2_p99': get_percentile(dhis2.latencies, 99),
+        'queries': queries,
+        'queries_per_record': float(queries) / max(1, records),
+        'summary': summary}
+
+
+def format_report(report):
+    def ms(seconds):
+        if seconds is None:
+            return '-'
+        return '%.1fms' % (seconds * 1000)
+    return (
+        "%(records)d records, %(services)d services, %(data_sets)d data "
+        "sets, concurrency %(concurrency)d, latency %(latency).3fs, error "
+        "rate %(error_rate).2f\n" % report +
+        "%.1f records/s in %.2fs, %d processed, %d failed\n" % (
+            report['records_per_second'], report['seconds'],
+            report['summary']['processed'], report['summary']['failed']) +
+        "record latency p50 %s p99 %s, DHIS2 request p50 %s p99 %s\n" % (
+            ms(report['p50']), ms(report['p99']), ms(report['dhis2_p50']),
+            ms(report['dhis2_p99'])) +
+        "%.2f queries/record, %d DHIS2 requests" % (
+            report['queries_per_record'], report['summary']['batches']))
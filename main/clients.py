@@ -0,0 +1,351 @@
+import base64
+import threading
+import time
+from urlparse import urlparse
+
+import httplib2
+
+from django.conf import settings
+
+
+class HttpPool(object):
+    """
+    Keeps idle httplib2.Http objects per host so that keep-alive
+    connections are reused across requests for the lifetime of the process.
+
+    At most settings.HTTP_POOL_SIZE idle objects are kept per host and an
+    object idle for longer than settings.HTTP_POOL_IDLE_TIMEOUT seconds is
+    closed instead of being reused.
+    """
+    size = None
+    idle_timeout = None
+    idle = None
+    stats = None
+
+    def __init__(self, size=None, idle_timeout=None):
+        self.size = size or settings.HTTP_POOL_SIZE
+        self.idle_timeout = idle_timeout or settings.HTTP_POOL_IDLE_TIMEOUT
+        self.idle = {}
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'discarded': 0}
+        self.lock = threading.Lock()
+
+    def create(self):
+        return httplib2.Http()
+
+    def close(self, http):
+        for conn in http.connections.values():
+            conn.close()
+        http.connections.clear()
+
+    def acquire(self, host):
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(host, [])
+            while idle:
+                http, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    self.stats['hits'] += 1
+                    return http
+                self.stats['expired'] += 1
+                self.close(http)
+            self.stats['misses'] += 1
+        return self.create()
+
+    def release(self, host, http):
+        with self.lock:
+            idle = self.idle.setdefault(host, [])
+            if len(idle) < self.size:
+                idle.append((http, time.time()))
+                return
+            self.stats['discarded'] += 1
+        self.close(http)
+
+    def discard(self, http):
+        with self.lock:
+            self.stats['discarded'] += 1
+        self.close(http)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['idle'] = sum([len(v) for v in self.idle.values()])
+        return stats
+
+
+class ChunkedBody(object):
+    """
+    File-like request body reading the str or unicode pieces get_pieces()
+    returns in HTTP/1.1 chunked transfer encoding, unicode is sent as UTF-8.
+
+    rewind() starts the body over with another call of get_pieces(), the
+    connections of HttpClient do so before every attempt of a request since
+    httplib2 resends requests on connections that went stale.
+    """
+    get_pieces = None
+    pieces = None
+    done = False
+
+    def __init__(self, get_pieces):
+        self.get_pieces = get_pieces
+
+    def rewind(self):
+        self.pieces = None
+        self.done = False
+
+    def read(self, size=-1):
+        if self.done:
+            return ''
+        if self.pieces is None:
+            self.pieces = iter(self.get_pieces())
+        for piece in self.pieces:
+            if isinstance(piece, unicode):
+                piece = piece.encode('utf-8')
+            if piece:
+                return '%x\r\n%s\r\n' % (len(piece), piece)
+        self.done = True
+        return '0\r\n\r\n'
+
+
+class RewindingHTTPConnection(httplib2.HTTPConnectionWithTimeout):
+    def request(self, method, url, body=None, headers={}):
+        if isinstance(body, ChunkedBody):
+            body.rewind()
+        httplib2.HTTPConnectionWithTimeout.request(
+            self, method, url, body, headers)
+
+
+class RewindingHTTPSConnection(httplib2.HTTPSConnectionWithTimeout):
+    def request(self, method, url, body=None, headers={}):
+        if isinstance(body, ChunkedBody):
+            body.rewind()
+        httplib2.HTTPSConnectionWithTimeout.request(
+            self, method, url, body, headers)
+
+
+CONNECTION_TYPES = {
+    'http': RewindingHTTPConnection,
+    'https': RewindingHTTPSConnection,
+}
+
+
+class HttpClient(object):
+    """
+    Issues requests through an HttpPool, sending a precomputed Basic
+    Authorization header when credentials are given.
+    """
+    pool = None
+    headers = None
+
+    def __init__(self, pool, username=None, password=None):
+        self.pool = pool
+        self.headers = {}
+        if username is not None:
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(
+                '%s:%s' % (username, password))
+
+    def request(self, url, method='GET', body=None, headers=None):
+        parsed = urlparse(url)
+        host = '%s://%s' % (parsed.scheme, parsed.netloc)
+        request_headers = dict(self.headers)
+        if headers:
+            request_headers.update(headers)
+        http = self.pool.acquire(host)
+        try:
+            resp, content = http.request(
+                url, method, body=body, headers=request_headers,
+                connection_type=CONNECTION_TYPES.get(parsed.scheme))
+        except Exception:
+            self.pool.discard(http)
+            raise
+        self.pool.release(host, http)
+        return resp, content
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to a failing service: after `threshold` consecutive
+    failures the circuit opens and requests are refused for `reset_timeout`
+    seconds, after which a single trial request is let through. A success
+    closes the circuit again, a failure reopens it.
+    """
+    threshold = None
+    reset_timeout = None
+    failures = 0
+    opened_on = None
+    trial = False
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        returns True if a request may be made now
+        """
+        with self.lock:
+            if self.opened_on is None:
+                return True
+            if self.trial or \
+                    time.time() - self.opened_on < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_on is not None and (
+                self.trial or
+                time.time() - self.opened_on < self.reset_timeout)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_on = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened_on = time.time()
+            self.trial = False
+
+
+class TokenBucket(object):
+    """
+    Lets at most `rate` requests per second through on average, with bursts
+    of up to `burst` requests. A rate of None lets every request through.
+    """
+    rate = None
+    burst = None
+    tokens = None
+    updated_on = None
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self.tokens = float(self.burst)
+        self.updated_on = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        takes a token, waiting for one if necessary, returns the seconds
+        waited
+        """
+        if not self.rate:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated_on) * self.rate)
+                self.updated_on = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits the number of requests in flight, adapting the limit AIMD style:
+    it grows by one per limit's worth of fast, successful responses and is
+    halved when a response is slower than `latency_target` seconds or the
+    service reports overload, never going below `minimum` or above
+    `maximum`.
+    """
+    limit = None
+    minimum = None
+    maximum = None
+    latency_target = None
+    in_flight = 0
+
+    def __init__(self, minimum, maximum, latency_target):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.latency_target = latency_target
+        self.stats = {'requests': 0, 'waits': 0, 'wait_time': 0.0,
+                      'decreases': 0}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        waits for a free slot, returns the seconds waited
+        """
+        started = time.time()
+        with self.condition:
+            waited = False
+            while self.in_flight >= int(self.limit):
+                waited = True
+                self.condition.wait()
+            self.in_flight += 1
+            self.stats['requests'] += 1
+            wait = time.time() - started
+            if waited:
+                self.stats['waits'] += 1
+                self.stats['wait_time'] += wait
+        return wait
+
+    def release(self, latency, overloaded=False):
+        """
+        frees a slot, adapting the limit to the request's latency and
+        whether the service reported overload
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded or latency > self.latency_target:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.stats['decreases'] += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['limit'] = int(self.limit)
+            stats['in_flight'] = self.in_flight
+        return stats
+
+
+_pool = None
+_clients = {}
+_lock = threading.RLock()
+
+
+def get_http_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = HttpPool()
+        return _pool
+
+
+def _get_client(name, *credentials):
+    with _lock:
+        if name not in _clients:
+            _clients[name] = HttpClient(get_http_pool(), *credentials)
+        return _clients[name]
+
+
+def get_formhub_client():
+    """
+    returns the process wide client for Formhub requests
+    """
+    return _get_client('formhub')
+
+
+def get_dhis2_client():
+    """
+    returns the process wide client for DHIS2 requests, authenticated with
+    settings.DHIS2_USERNAME and settings.DHIS2_PASSWORD
+    """
+    return _get_client('dhis2', settings.DHIS2_USERNAME,
+                       settings.DHIS2_PASSWORD)
@@ -1,11 +1,47 @@
 import json
+from datetime import datetime
 from django import forms
+from django.db import transaction
 from django.db.utils import IntegrityError
 from django.forms.models import ModelForm
+from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext as _
 
 from main.models import DataSet, DataElement, FormhubService, OrganizationUnit, DataValueSet
-from main.utils import load_from_dhis2, load_form_from_formhub
+from main.utils import (get_org_unit_pks, load_from_dhis2,
+                        load_form_from_formhub)
+
+
+@transaction.commit_on_success
+def import_data_set(data, url):
+    """
+    saves a DHIS2 data set with its data elements and organisation units
+    using a handful of set based queries, existing organisation units are
+    matched by their id
+    """
+    ds = DataSet(data_set_id=data['id'],
+        name=data['name'],
+        frequency=DataSet.get_frequency(data['periodType']),
+        url=url, last_synced_on=datetime.utcnow())
+    ds.save()
+    DataElement.objects.bulk_create([
+        DataElement(data_element_id=de['id'], name=de['name'], data_set=ds)
+        for de in data['dataElements']])
+    names = SortedDict([(orgunit['id'], orgunit['name'])
+                        for orgunit in data['organisationUnits']])
+    org_units = get_org_unit_pks(names.keys())
+    OrganizationUnit.objects.bulk_create([
+        OrganizationUnit(org_unit_id=org_unit_id, name=name)
+        for org_unit_id, name in names.items()
+        if org_unit_id not in org_units])
+    # pks of bulk created rows are not returned on every backend
+    org_units.update(get_org_unit_pks(
+        [org_unit_id for org_unit_id in names if org_unit_id not in org_units]))
+    through = DataSet.organizations.through
+    through.objects.bulk_create([
+        through(dataset_id=ds.pk, organizationunit_id=org_units[org_unit_id])
+        for org_unit_id in names])
+    return ds
 
 
 class DataSetImportForm(forms.Form):
@@ -22,29 +58,13 @@ class DataSetImportForm(forms.Form):
                 data = json.loads(ds_data)
                 if not isinstance(data, dict):
                     return False
-                # period
-                frequency = DataSet.get_frequency(data['periodType'])
                 try:
-                    ds = DataSet(data_set_id=data['id'],
-                        name=data['name'],
-                        frequency=frequency,
-                        url=cleaned_url.replace('.json', ''))
-                    ds.save()
+                    ds = import_data_set(data, cleaned_url.replace('.json', ''))
                 except IntegrityError, e:
                     return {
                         'ds_status':
                             _(u"%(dataset)s has already been added." %\
                               {'dataset': data['name']})}
-                for de in data['dataElements']:
-                    element = DataElement(data_element_id=de['id'],
-                        name=de['name'],
-                        data_set=ds)
-                    element.save()
-                for orgunit in data['organisationUnits']:
-                    org, created = OrganizationUnit.objects.get_or_create(org_unit_id=orgunit['id'],
-                        name=orgunit['name'])
-                    #org.save()
-                    ds.organizations.add(org)
                 summary['dataSet'] = ds
                 summary['dataElements'] = data['dataElements'].__len__()
                 summary['orgUnits'] = data['organisationUnits'].__len__()
@@ -77,15 +97,19 @@ class DataValueSetForm(ModelForm):
 
 
 class FHDataElementForm(forms.Form):
-    DVS_TUPLE = tuple([(dvs.pk, '%s' % dvs) for dvs in DataValueSet.objects.all()])
-    DVS_SELECT_CHOICES = (('', ' ------ '),) + DVS_TUPLE
-    DE_TUPLE = tuple([(de.pk, '%s' % de) for de in DataElement.objects.all()])
-    DE_CHOICES = (('', ' ------ '),) + DE_TUPLE
-
-    dvs = forms.ChoiceField(widget=forms.Select, choices=DVS_SELECT_CHOICES)
-    data_elements = forms.ChoiceField(widget=forms.Select, choices=DE_CHOICES)
+    dvs = forms.ChoiceField(widget=forms.Select)
+    data_elements = forms.ChoiceField(widget=forms.Select)
     fh_fields = forms.ChoiceField(widget=forms.Select)
 
+    def __init__(self, *args, **kwargs):
+        super(FHDataElementForm, self).__init__(*args, **kwargs)
+        # choices are looked up per form, not when the module is imported,
+        # so every process sees the current ones
+        self.fields['dvs'].choices = (('', ' ------ '),)\
+            + DataValueSet.get_choices()
+        self.fields['data_elements'].choices = (('', ' ------ '),)\
+            + DataElement.get_choices()
+
     def set_data_elements_choices(self, dvs):
         self.fields['data_elements'].choices = (('', ' ------ '),)\
                     + tuple([(de.pk, '%s' % de)
@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import FormhubService
+from main.utils import DataValueSetBatch, FormhubBackfill
+
+
+class Command(BaseCommand):
+    args = '<id_string>'
+    help = "Sends all existing submissions of a Formhub form to DHIS2."
+    option_list = BaseCommand.option_list + (
+        make_option('--page-size', type='int', dest='page_size',
+                    help="Formhub records requested at a time"),
+        make_option('--concurrency', type='int', dest='concurrency',
+                    help="pages fetched and batches sent at once"),
+        make_option('--batch-sets', type='int', dest='batch_sets',
+                    help="data value sets per DHIS2 request"),
+        make_option('--start', type='int', dest='start',
+                    help="number of records to skip, by default an "
+                    "unfinished backfill is resumed"),
+        make_option('--restart', action='store_true', dest='restart',
+                    default=False,
+                    help="start from the first record"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the id_string of one Formhub form.")
+        try:
+            service = FormhubService.objects.get(id_string=args[0])
+        except FormhubService.DoesNotExist:
+            raise CommandError("No Formhub form %s." % args[0])
+        except FormhubService.MultipleObjectsReturned:
+            raise CommandError("More than one Formhub form %s." % args[0])
+        offset = options['start']
+        if options['restart']:
+            offset = 0
+        batch = None
+        if options['batch_sets']:
+            batch = DataValueSetBatch(max_sets=options['batch_sets'])
+        summary = FormhubBackfill(
+            service, page_size=options['page_size'], batch=batch,
+            concurrency=options['concurrency'],
+            offset=offset).run()
+        self.stdout.write(
+            "%(records)d records in %(seconds).1fs, "
+            "%(records_per_second).1f records/s\n"
+            "%(processed)d sent, %(failed)d queued for retry, "
+            "%(sets)d data value sets in %(batches)d DHIS2 requests, "
+            "%(pages)d Formhub pages" % summary)
+        if summary['fetch_failed'] or summary['circuit_open']:
+            self.stdout.write(
+                "Stopped early after %d records, run again to resume" %
+                summary['next_offset'])
@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from main.benchmark import format_report, run_benchmark
+
+
+class Command(BaseCommand):
+    help = "Measures how fast queued submissions are sent, against local " \
+        "Formhub and DHIS2 stand-ins and in a throwaway test database."
+    option_list = BaseCommand.option_list + (
+        make_option('--records', type='int', dest='records', default=1000),
+        make_option('--services', type='int', dest='services', default=1),
+        make_option('--data-sets', type='int', dest='data_sets', default=1),
+        make_option('--latency', type='float', dest='latency', default=0,
+                    help="seconds each fake server takes to answer"),
+        make_option('--error-rate', type='float', dest='error_rate',
+                    default=0, help="share of requests answered with 503"),
+        make_option('--concurrency', type='int', dest='concurrency',
+                    default=1),
+        make_option('--batch-sets', type='int', dest='batch_sets',
+                    help="data value sets per DHIS2 request"),
+    )
+
+    def handle(self, *args, **options):
+        if 'south' in settings.INSTALLED_APPS:
+            # build the test database with the migrations
+            from south.management.commands import patch_for_test_db_setup
+            patch_for_test_db_setup()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            report = run_benchmark(
+                options['records'], options['services'],
+                options['data_sets'], options['latency'],
+                options['error_rate'], options['concurrency'],
+                options['batch_sets'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.stdout.write(format_report(report))
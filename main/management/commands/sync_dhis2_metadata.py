@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from main.models import DataSet
+from main.utils import sync_dhis2_metadata
+
+
+class Command(BaseCommand):
+    args = '[data_set_id ...]'
+    help = "Syncs imported data sets, their data elements and organisation " \
+        "units with the metadata changed on DHIS2 since their last sync."
+
+    def handle(self, *args, **options):
+        data_sets = DataSet.objects.filter(url__isnull=False)
+        if args:
+            data_sets = data_sets.filter(data_set_id__in=args)
+        for data_set_id, summary in sorted(
+                sync_dhis2_metadata(data_sets).items()):
+            if summary is None:
+                self.stdout.write("%s: DHIS2 could not be reached" %
+                                  data_set_id)
+                continue
+            self.stdout.write(
+                "%s: data elements %d added, %d renamed, %d removed; "
+                "org units %d added, %d renamed, %d removed" % (
+                    data_set_id, summary['elements_added'],
+                    summary['elements_renamed'], summary['elements_removed'],
+                    summary['org_units_added'], summary['org_units_renamed'],
+                    summary['org_units_removed']))
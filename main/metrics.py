@@ -0,0 +1,208 @@
+"""
+Timings of the stages data goes through on its way to DHIS2, kept as
+histograms per run and per Formhub service, and the counters and text
+format of the metrics view.
+"""
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, float('inf'))
+
+# the stages timed by the queue processor, in pipeline order
+STAGES = ('fetch', 'load_dict', 'render', 'send')
+
+
+class Histogram(object):
+    """
+    Counts observed durations into the fixed BUCKETS
+    """
+    count = 0
+    total = 0.0
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                return
+
+    def get_percentile(self, percent):
+        """
+        returns the upper bound of the bucket holding the given percentile,
+        None if nothing was observed
+        """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.get_percentile(50),
+                'p99': self.get_percentile(99),
+                'buckets': [(bound, count) for bound, count
+                            in zip(BUCKETS, self.counts) if count]}
+
+
+class StageMetrics(object):
+    """
+    Histograms of the stage durations of one run, overall and per Formhub
+    service, safe to observe from worker threads
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.services = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, service_ids=()):
+        """
+        records a duration of stage, once for the run and once for each of
+        the services whose data it was spent on
+        """
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+            for service_id in service_ids:
+                stages = self.services.setdefault(service_id, {})
+                if stage not in stages:
+                    stages[stage] = Histogram()
+                stages[stage].observe(seconds)
+
+    def to_dict(self):
+        """
+        returns {'stages': {stage: histogram}, 'services': {service_id:
+        {stage: histogram}}} with histograms as Histogram.to_dict() gives
+        """
+        with self.lock:
+            return {
+                'stages': dict([(stage, histogram.to_dict())
+                                for stage, histogram in self.stages.items()]),
+                'services': dict([
+                    (service_id, dict([(stage, histogram.to_dict())
+                                       for stage, histogram
+                                       in stages.items()]))
+                    for service_id, stages in self.services.items()])}
+
+
+# DHIS2 response statuses counted on their own, others are counted by class
+DHIS2_STATUSES = (200, 201, 202, 204, 400, 401, 403, 404, 409, 429, 500,
+                  502, 503, 504)
+DHIS2_STATUS_LABELS = [str(status) for status in DHIS2_STATUSES] + \
+    ['%dxx' % i for i in range(1, 6)] + ['error']
+
+
+def get_status_label(status):
+    """
+    returns the label a DHIS2 response status is counted under, 'error' for
+    requests that got no response
+    """
+    if status is None:
+        return 'error'
+    if status in DHIS2_STATUSES:
+        return str(status)
+    return '%dxx' % (status // 100)
+
+
+def get_counter_key(name, label):
+    return 'metrics:%s:%s' % (name, label)
+
+
+def incr_counter(name, label, delta=1):
+    """
+    adds delta to a counter kept in the cache, so it is shared between the
+    processes when CACHES is
+    """
+    if not delta:
+        return
+    key = get_counter_key(name, label)
+    timeout = settings.METRICS_COUNTER_TIMEOUT
+    if cache.add(key, delta, timeout):
+        return
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # expired since
+        cache.add(key, delta, timeout)
+
+
+def get_counters(name, labels):
+    """
+    returns (label, value) pairs of the counters of name
+    """
+    keys = [get_counter_key(name, label) for label in labels]
+    values = cache.get_many(keys)
+    return [(label, values.get(key, 0)) for label, key in zip(labels, keys)]
+
+
+def set_gauge(name, value):
+    cache.set(get_counter_key(name, 'value'), value,
+              settings.METRICS_COUNTER_TIMEOUT)
+
+
+def get_gauge(name):
+    """
+    returns the value last set, None if there is none
+    """
+    return cache.get(get_counter_key(name, 'value'))
+
+
+def record_dhis2_response(status):
+    incr_counter('dhis2_responses', get_status_label(status))
+
+
+def get_dhis2_response_counts():
+    return get_counters('dhis2_responses', DHIS2_STATUS_LABELS)
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_metrics(families):
+    """
+    returns families of (name, type, help, [(labels, value)]) samples in
+    the Prometheus text exposition format, labels being a list of
+    (name, value) pairs
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(u'# HELP %s %s' % (name, help_text))
+        lines.append(u'# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            if labels:
+                name_labels = u'%s{%s}' % (name, u','.join(
+                    [u'%s="%s"' % (label, escape_label(label_value))
+                     for label, label_value in labels]))
+            else:
+                name_labels = name
+            lines.append(u'%s %s' % (name_labels, format_value(value)))
+    return u'\n'.join(lines) + u'\n'
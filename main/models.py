@@ -1,4 +1,9 @@
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Sum
 from django.utils import simplejson
 from django.utils.translation import ugettext as _
 
@@ -23,12 +28,53 @@ class FormhubService(models.Model):
         return u"%s (%s)" % (self.name, self.id_string)
 
     def get_form_fields(self):
-        y = simplejson.loads(self.json)
-        rs = ()
-        if y.has_key('children'):
-            for v in y['children']:
-                rs += ((v['name'], v.get('label', v['name'])),)
-        return rs
+        """
+        returns (path, label) choices of the questions a submission value
+        can be mapped from, questions inside repeats are left out as they
+        have no single value
+        """
+        return tuple([(field['path'], field['label'])
+                      for field in self.get_field_index()
+                      if not field['repeat']])
+
+    @classmethod
+    def build_field_index(cls, children, prefix=u'', repeat=None):
+        fields = []
+        for child in children:
+            path = prefix + child['name']
+            if child.get('type') in ('group', 'repeat') and \
+                    'children' in child:
+                fields.extend(cls.build_field_index(
+                    child['children'], path + u'/',
+                    path if child['type'] == 'repeat' else repeat))
+                continue
+            fields.append({'path': path, 'name': child['name'],
+                           'label': child.get('label', child['name']),
+                           'type': child.get('type'), 'repeat': repeat})
+        return fields
+
+    def get_field_index(self):
+        """
+        returns the questions of the form in form order as
+        [{'path': ..., 'name': ..., 'label': ..., 'type': ...,
+          'repeat': ...}, ...], path is the question's key in submissions,
+        e.g. group/question, and repeat the path of the enclosing repeat if
+        any
+
+        The index is cached by the content of json, so it is parsed once
+        per form definition.
+        """
+        json_hash = md5(self.json.encode('utf-8')).hexdigest()
+        index = getattr(self, '_field_index', None)
+        if index is None or index[0] != json_hash:
+            key = 'formhub-field-index-%s' % json_hash
+            fields = cache.get(key)
+            if fields is None:
+                form = simplejson.loads(self.json)
+                fields = self.build_field_index(form.get('children', []))
+                cache.set(key, fields, settings.FORM_FIELD_INDEX_CACHE_TIMEOUT)
+            index = self._field_index = (json_hash, fields)
+        return index[1]
 
 
 class OrganizationUnit(models.Model):
@@ -81,6 +127,9 @@ class DataSet(models.Model):
     frequency = models.PositiveIntegerField(choices=FREQUENCY_CHOICES, default=FREQUENCY_MONTHLY)
     organizations = models.ManyToManyField(OrganizationUnit)
     url = models.URLField(_(u"URL"), null=True)
+    # metadata changed on DHIS2 since then, in UTC, is yet to be synced
+    last_synced_on = models.DateTimeField(_(u"Last synced on"), null=True,
+                                          blank=True)
     created_on = models.DateTimeField(_(u"Created on"), auto_now_add=True)
     modified_on = models.DateTimeField(_(u"Modified on"), auto_now=True)
 
@@ -109,6 +158,47 @@ class DataValueSet(models.Model):
     def __unicode__(self):
         return u"%s (%s)" % (self.service, self.data_set)
 
+    @classmethod
+    def get_choices(cls):
+        """
+        returns (pk, name) choices of all data value sets, with one query
+        """
+        return tuple([(dvs.pk, u'%s' % dvs) for dvs in
+                      cls.objects.select_related('service', 'data_set')])
+
+    def build_mapping_plan(self):
+        rows = DataValueSet.objects.filter(pk=self.pk).values_list(
+            'data_set__data_set_id', 'data_set__frequency',
+            'formdataelement__form_field',
+            'formdataelement__data_element__data_element_id')\
+            .order_by('formdataelement__pk')
+        plan = {'data_set_id': None, 'frequency': None, 'fields': []}
+        fields = {}
+        for data_set_id, frequency, form_field, data_element_id in rows:
+            plan['data_set_id'] = data_set_id
+            plan['frequency'] = frequency
+            if form_field is None:
+                continue
+            if form_field not in fields:
+                fields[form_field] = []
+                plan['fields'].append((form_field, fields[form_field]))
+            fields[form_field].append(data_element_id)
+        return plan
+
+    def get_mapping_plan(self):
+        """
+        returns how submissions map onto the data set as
+        {'data_set_id': ..., 'frequency': ...,
+         'fields': [(form_field, [data_element_id, ...]), ...]}
+
+        The plan is built with a single query and kept by the instance for
+        its lifetime, e.g. a queue run, so changed mappings are picked up by
+        the next one whichever process they were made in.
+        """
+        if getattr(self, '_mapping_plan', None) is None:
+            self._mapping_plan = self.build_mapping_plan()
+        return self._mapping_plan
+
 
 class DataElement(models.Model):
 
@@ -128,6 +218,13 @@ class DataElement(models.Model):
     def __unicode__(self):
         return u"%s (%s)" % (self.name, self.data_element_id)
 
+    @classmethod
+    def get_choices(cls):
+        """
+        returns (pk, name) choices of all data elements
+        """
+        return tuple([(de.pk, u'%s' % de) for de in cls.objects.all()])
+
 
 class FormDataElement(models.Model):
 
@@ -140,7 +237,7 @@ class FormDataElement(models.Model):
 
     data_value_set = models.ForeignKey(DataValueSet, verbose_name=_(u"Data Value Set"))
     data_element = models.ForeignKey(DataElement,verbose_name=_(u"Data Element"))
-    form_field = models.CharField(_(u"Form Field"), max_length=32)
+    form_field = models.CharField(_(u"Form Field"), max_length=255)
     created_on = models.DateTimeField(_(u"Created on"), auto_now_add=True)
     modified_on = models.DateTimeField(_(u"Modified on"), auto_now=True)
 
@@ -150,18 +247,145 @@ class FormDataElement(models.Model):
 
 class DataQueue(models.Model):
 
+    STATUS_PENDING = 0
+    STATUS_PROCESSED = 1
+    STATUS_MISSING = 2
+    STATUS_FAILED = 3
+    STATUS_DEAD = 4
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _(u"Pending")),
+        (STATUS_PROCESSED, _(u"Processed")),
+        (STATUS_MISSING, _(u"Missing on Formhub")),
+        (STATUS_FAILED, _(u"Failed")),
+        (STATUS_DEAD, _(u"Dead letter")),
+    )
+
     class Meta:
         app_label = 'main'
         db_table = 'dhis_data_queue'
         verbose_name = _(u"Data Queue")
         verbose_name_plural = _(u"Data Queue")
+        # the queue depth and lag the metrics view reports
+        index_together = [['processed', 'service', 'status'],
+                          ['processed', 'created_on']]
 
     processed = models.BooleanField(_(u"Processed"), default=False)
-    processed_on = models.DateTimeField(_(u"Processed on"), null=True)
+    processed_on = models.DateTimeField(_(u"Processed on"), null=True,
+                                        db_index=True)
+    status = models.PositiveSmallIntegerField(
+        _(u"Status"), choices=STATUS_CHOICES, default=STATUS_PENDING)
+    message = models.TextField(_(u"Message"), null=True, blank=True)
+    attempts = models.PositiveIntegerField(_(u"Attempts"), default=0)
+    next_attempt_on = models.DateTimeField(_(u"Next attempt on"), null=True,
+                                           blank=True, db_index=True)
+    leased_by = models.CharField(_(u"Leased by"), max_length=64, null=True,
+                                 blank=True)
+    lease_expires = models.DateTimeField(_(u"Lease expires"), null=True,
+                                         blank=True, db_index=True)
     data_id = models.CharField(_(u"Formhub Id"), max_length=32)
+    # the submission as pushed by Formhub, it is then not fetched again
+    payload = models.TextField(_(u"Payload"), null=True, blank=True)
     service = models.ForeignKey(FormhubService, verbose_name=_(u"Formhub Service"))
     created_on = models.DateTimeField(_(u"Created on"), auto_now_add=True)
     modified_on = models.DateTimeField(_(u"Modified on"), auto_now=True)
 
     def __unicode__(self):
         return u"%s - %s" % (self.service, self.data_id)
+
+
+class SentPayload(models.Model):
+    """
+    Digest of the data value set last accepted by DHIS2 for a queued
+    submission, an unchanged re-submission is not sent again
+    """
+
+    class Meta:
+        app_label = 'main'
+        db_table = 'dhis_sent_payload'
+        verbose_name = _(u"Sent Payload")
+        verbose_name_plural = _(u"Sent Payloads")
+        unique_together = ('data_queue', 'data_value_set')
+
+    data_queue = models.ForeignKey(DataQueue, verbose_name=_(u"Data Queue"))
+    data_value_set = models.ForeignKey(DataValueSet,
+                                       verbose_name=_(u"Data Value Set"))
+    digest = models.CharField(_(u"Digest"), max_length=32)
+    sent_on = models.DateTimeField(_(u"Sent on"))
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.data_queue, self.digest)
+
+
+class BackfillCheckpoint(models.Model):
+    """
+    How far the backfill of a Formhub form got, see utils.FormhubBackfill
+    """
+
+    class Meta:
+        app_label = 'main'
+        db_table = 'dhis_backfill_checkpoint'
+        verbose_name = _(u"Backfill Checkpoint")
+        verbose_name_plural = _(u"Backfill Checkpoints")
+
+    service = models.OneToOneField(FormhubService,
+                                   verbose_name=_(u"Formhub Service"))
+    # records before it have all been acknowledged by DHIS2
+    offset = models.PositiveIntegerField(_(u"Offset"), default=0)
+    finished_on = models.DateTimeField(_(u"Finished on"), null=True,
+                                       blank=True)
+    created_on = models.DateTimeField(_(u"Created on"), auto_now_add=True)
+    modified_on = models.DateTimeField(_(u"Modified on"), auto_now=True)
+
+    def __unicode__(self):
+        return u"%s: %d" % (self.service, self.offset)
+
+
+class MetadataCache(models.Model):
+    """
+    A DHIS2 metadata response kept for conditional requests, see
+    utils.load_from_dhis2()
+    """
+
+    class Meta:
+        app_label = 'main'
+        db_table = 'dhis_metadata_cache'
+        verbose_name = _(u"Metadata Cache")
+        verbose_name_plural = _(u"Metadata Cache")
+
+    url_hash = models.CharField(_(u"URL hash"), max_length=32, unique=True)
+    url = models.TextField(_(u"URL"))
+    etag = models.CharField(_(u"ETag"), max_length=255, null=True,
+                            blank=True)
+    last_modified = models.CharField(_(u"Last modified"), max_length=64,
+                                     null=True, blank=True)
+    content = models.TextField(_(u"Content"))
+    size = models.PositiveIntegerField(_(u"Size"), default=0)
+    fetched_on = models.DateTimeField(_(u"Fetched on"))
+    used_on = models.DateTimeField(_(u"Used on"), db_index=True)
+
+    def __unicode__(self):
+        return self.url
+
+    @staticmethod
+    def get_url_hash(url):
+        return md5(url.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def evict(cls, max_size):
+        """
+        deletes the least recently used entries until the cached content
+        takes at most max_size bytes, returns the number deleted
+        """
+        total = cls.objects.aggregate(total=Sum('size'))['total'] or 0
+        deleted = []
+        for pk, size in cls.objects.order_by('used_on')\
+                .values_list('pk', 'size').iterator():
+            if total <= max_size:
+                break
+            deleted.append(pk)
+            total -= size
+        if deleted:
+            cls.objects.filter(pk__in=deleted).delete()
+        return len(deleted)
+
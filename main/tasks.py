@@ -1,7 +1,61 @@
-from celery.task import task
-from main.utils import process_data_queue
+from datetime import timedelta
+
+from celery.task import periodic_task, task
+from django.conf import settings
+from django.core.cache import cache
+
+from main.utils import (process_data_queue, release_expired_leases,
+                        sync_dhis2_metadata)
+
+
+def get_pending_run_key(service_id=None):
+    return 'process-dqueue-pending-%s' % (service_id or 'all')
 
 
 @task()
-def process_dqueue():
-    process_data_queue()
\ No newline at end of file
+def process_dqueue(concurrency=None, service_id=None):
+    return process_data_queue(concurrency=concurrency, service_id=service_id)
+
+
+def schedule_process_dqueue(service=None):
+    """
+    Starts a process_dqueue run for the service in
+    settings.DATA_QUEUE_TRIGGER_DELAY seconds unless a run is already
+    waiting to start, so a burst of submissions is drained by a few runs
+    instead of one per submission.
+
+    The pending run is only marked for the delay, the run starts no earlier
+    and picks up everything queued until then, so it need not be unmarked
+    by the worker, whose cache may not be the web process's.
+
+    Returns True if a run was scheduled.
+    """
+    service_id = service.pk if service is not None else None
+    delay = settings.DATA_QUEUE_TRIGGER_DELAY
+    if not cache.add(get_pending_run_key(service_id), True, delay):
+        return False
+    process_dqueue.apply_async(kwargs={'service_id': service_id},
+                               countdown=delay)
+    return True
+
+
+@periodic_task(run_every=timedelta(
+    seconds=settings.DATA_QUEUE_DRAIN_INTERVAL))
+def drain_dqueue():
+    """
+    sends the items of every service that came due for another attempt,
+    webhooks only trigger runs for services that got new submissions
+    """
+    return process_data_queue()
+
+
+@periodic_task(run_every=timedelta(
+    seconds=settings.DATA_QUEUE_LEASE_TIMEOUT))
+def release_dqueue_leases():
+    return release_expired_leases()
+
+
+@periodic_task(run_every=timedelta(
+    seconds=settings.DHIS2_METADATA_SYNC_INTERVAL))
+def sync_metadata():
+    return sync_dhis2_metadata()
@@ -1,10 +1,40 @@
 import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from StringIO import StringIO
+from datetime import datetime, timedelta
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import Client
-from main import views
-from main.models import DataSet, FormhubService
+from django.test.utils import override_settings
+from main import forms, metrics, models, tasks, utils, views
+from main.benchmark import (FakeDHIS2Server, FakeFormhubServer, format_report,
+                            run_benchmark)
+from main.forms import FHDataElementForm
+from main.clients import AdaptiveLimiter, ChunkedBody, HttpPool, TokenBucket
+from main.models import (BackfillCheckpoint, DataElement, DataSet, DataQueue,
+                         DataValueSet, FormDataElement, FormhubService,
+                         MetadataCache, OrganizationUnit, SentPayload)
+
+
+def _create_service(id_string='dhis2form', json='{}'):
+    return FormhubService.objects.create(
+        id_string=id_string, name=id_string, json=json,
+        url='http://formhub.org/ukanga/forms/%s/form.json' % id_string)
+
+
+def _create_data_value_set(service, i=0, **kwargs):
+    ds = DataSet.objects.create(data_set_id='ds%d' % i,
+                                name='Data Set %d' % i, **kwargs)
+    return DataValueSet.objects.create(service=service, data_set=ds)
 
 
 class Main(TestCase):
@@ -13,11 +43,22 @@ class Main(TestCase):
         self.password = 'bob'
         self.client = Client()
         self.base_url = 'http://testserver'
-        self.ds_url = u'http://apps.dhis2.org/demo/api/dataSets/pBOMPrpg1QX'
-        self.fh_url = u"http://formhub.org/ukanga/forms/dhis2form"
+        self.dhis2 = FakeDHIS2Server()
+        self.dhis2.metadata = ('"v1"', json.dumps({
+            'id': 'pBOMPrpg1QX', 'name': 'Mortality < 5 years',
+            'periodType': 'Monthly',
+            'dataElements': [{'id': 'de0', 'name': 'Deaths'}],
+            'organisationUnits': [{'id': 'ou0', 'name': 'Clinic'}]}))
+        self.formhub = FakeFormhubServer()
+        self.ds_url = self.dhis2.base_url + '/demo/api/dataSets/pBOMPrpg1QX'
+        self.fh_url = self.formhub.url
         self.ds_import_url = reverse(views.dataset_import)
         self.fh_import_url = reverse(views.formhub_import)
 
+    def tearDown(self):
+        self.dhis2.close()
+        self.formhub.close()
+
     def _create_user(self, username, password):
         user, created = User.objects.get_or_create(username=username)
         user.set_password(password)
@@ -102,4 +143,1262 @@ class Main(TestCase):
         # pass in Basic HTTP Authentication headers, correct user/pass
         response = self.client.get(url,
             **self._set_auth_headers(self.username, self.password))
-        self.assertEqual(response.status_code, 200)
\ No newline at end of file
+        self.assertEqual(response.status_code, 200)
+
+
+class DataQueueProcessing(TestCase):
+    def setUp(self):
+        self.fetched = []
+        self.sent = []
+        self._get_data_from_formub = utils.get_data_from_formub
+        self._get_submissions_from_formhub = \
+            utils.get_submissions_from_formhub
+        self._send_to_dhis2 = utils.send_to_dhis2
+        utils.get_data_from_formub = self._fake_get_data_from_formub
+        utils.get_submissions_from_formhub = \
+            self._fake_get_submissions_from_formhub
+        utils.send_to_dhis2 = self._fake_send_to_dhis2
+        self._get_submission_page = utils.get_submission_page
+        utils.get_submission_page = self._fake_get_submission_page
+        utils.circuit_breakers.clear()
+        self.service = _create_service()
+        for i in range(3):
+            _create_data_value_set(self.service, i)
+
+    def tearDown(self):
+        utils.get_data_from_formub = self._get_data_from_formub
+        utils.get_submissions_from_formhub = \
+            self._get_submissions_from_formhub
+        utils.send_to_dhis2 = self._send_to_dhis2
+        utils.get_submission_page = self._get_submission_page
+
+    def _record(self, uuid):
+        return {'_uuid': uuid, 'period': '2013-01-15',
+                'location': self.locations.get(uuid, 'ou-%s' % uuid),
+                'count': uuid}
+
+    def _fake_get_data_from_formub(self, service, id=None):
+        self.fetched.append(id)
+        return [self._record(id)]
+
+    def _fake_get_submissions_from_formhub(self, service, uuids):
+        self.fetched.append(list(uuids))
+        return dict([(uuid, [self._record(uuid)]) for uuid in uuids
+                     if uuid != 'missing'])
+
+    def _fake_get_submission_page(self, service, start, limit):
+        self.fetched.append(start)
+        return [self._record('uuid%d' % i)
+                for i in range(start, min(start + limit, self.submissions))]
+
+    submissions = 7
+
+    def _fake_send_to_dhis2(self, xml, content_type="application/xml",
+                            content_encoding=None):
+        if callable(xml):
+            xml = u''.join(xml())
+        self.sent.append(xml)
+        return self.status, self.import_summary
+
+    import_summary = '<importSummary><status>SUCCESS</status></importSummary>'
+    status = 200
+    locations = {}
+
+    def test_submission_fetched_once_per_data_value_set(self):
+        DataQueue.objects.create(service=self.service, data_id='uuid1')
+        summary = utils.process_data_queue()
+        self.assertEqual(self.fetched, [['uuid1']])
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0].count('<dataValueSet '), 3)
+        self.assertEqual(summary['processed'], 1)
+        self.assertEqual(summary['fetches'], 1)
+        self.assertEqual(summary['saved_fetches'], 2)
+        self.assertTrue(DataQueue.objects.get(data_id='uuid1').processed)
+
+    def test_pending_submissions_fetched_in_chunks(self):
+        for uuid in ['uuid1', 'uuid2', 'missing', 'uuid3']:
+            DataQueue.objects.create(service=self.service, data_id=uuid)
+        summary = utils.DataQueueProcessor(chunk_size=3).run()
+        self.assertEqual(self.fetched,
+                         [['uuid1', 'uuid2', 'missing'], ['uuid3']])
+        self.assertEqual(summary['processed'], 3)
+        self.assertEqual(summary['missing'], 1)
+        self.assertEqual(summary['saved_fetches'], 10)
+        dq = DataQueue.objects.get(data_id='missing')
+        self.assertFalse(dq.processed)
+        self.assertEqual(dq.status, DataQueue.STATUS_MISSING)
+
+    def test_chunks_fetched_while_earlier_items_rendered(self):
+        for i in range(6):
+            DataQueue.objects.create(service=self.service,
+                                     data_id='uuid%d' % i)
+        rendered = []
+
+        class Processor(utils.DataQueueProcessor):
+            def process_item(processor, dq):
+                rendered.append((dq.data_id, len(self.fetched)))
+                super(Processor, processor).process_item(dq)
+        summary = Processor(chunk_size=2).run()
+        self.assertEqual(summary['processed'], 6)
+        # each chunk is fetched once its first item comes up
+        self.assertEqual([fetches for uuid, fetches in rendered],
+                         [1, 1, 2, 2, 3, 3])
+        del rendered[:]
+        self.fetched = []
+        DataQueue.objects.update(processed=False)
+        SentPayload.objects.all().delete()
+        Processor(chunk_size=1, concurrency=2).run()
+        # no more than concurrency chunks ahead of the items rendered
+        for i, (uuid, fetches) in enumerate(rendered):
+            self.assertTrue(i < fetches <= i + 2)
+
+    def test_data_value_sets_posted_in_batches(self):
+        for uuid in ['uuid1', 'uuid2', 'uuid3']:
+            DataQueue.objects.create(service=self.service, data_id=uuid)
+        batch = utils.DataValueSetBatch(max_sets=4)
+        summary = utils.DataQueueProcessor(batch=batch).run()
+        self.assertEqual([xml.count('<dataValueSet ') for xml in self.sent],
+                         [4, 4, 1])
+        self.assertEqual(summary['batches'], 3)
+        self.assertEqual(summary['processed'], 3)
+
+    def test_import_conflicts_mapped_to_queue_items(self):
+        self.import_summary = (
+            '<importSummary xmlns="http://dhis2.org/schema/dxf/2.0">'
+            '<status>WARNING</status><conflicts>'
+            '<conflict object="ou-uuid2" value="Org unit not found" />'
+            '</conflicts></importSummary>')
+        for uuid in ['uuid1', 'uuid2']:
+            DataQueue.objects.create(service=self.service, data_id=uuid)
+        summary = utils.process_data_queue()
+        self.assertEqual(summary['processed'], 1)
+        self.assertEqual(summary['failed'], 1)
+        dq = DataQueue.objects.get(data_id='uuid2')
+        self.assertFalse(dq.processed)
+        self.assertEqual(dq.status, DataQueue.STATUS_FAILED)
+        self.assertTrue('Org unit not found' in dq.message)
+        self.assertTrue(DataQueue.objects.get(data_id='uuid1').processed)
+
+    def test_conflict_on_shared_data_element_resent_per_set(self):
+        conflict = (
+            '<importSummary><status>WARNING</status><conflicts>'
+            '<conflict object="deA" value="Value must be a number" />'
+            '</conflicts></importSummary>')
+
+        def send_to_dhis2(body, content_type, content_encoding=None):
+            self._fake_send_to_dhis2(body, content_type, content_encoding)
+            if 'value="x"' in self.sent[-1]:
+                return 200, conflict
+            return 200, self.import_summary
+        utils.send_to_dhis2 = send_to_dhis2
+        batch = utils.DataValueSetBatch(
+            codec=utils.XMLPayloadCodec(stream=True), gzip=False)
+        for owner, value in [('good1', '1'), ('bad', 'x'), ('good2', '2')]:
+            batch.add(owner, None, {
+                'dataSet': 'ds0', 'orgUnit': 'ou-%s' % owner,
+                'period': '201301', 'completeDate': '2013-01-15',
+                'dataElements': [{'id': 'deA', 'value': value}]})
+        results = batch.send()
+        self.assertEqual(sorted(results), [
+            ('bad', False, u'deA: Value must be a number'),
+            ('good1', True, None), ('good2', True, None)])
+        # the batch, then each set it couldn't attribute the conflict to
+        self.assertEqual([xml.count('<dataValueSet ') for xml in self.sent],
+                         [3, 1, 1, 1])
+
+    def test_concurrent_run_keeps_order_per_org_unit_period_and_data_set(self):
+        dvs = DataValueSet.objects.get(data_set__data_set_id='ds0')
+        de = DataElement.objects.create(data_element_id='de1', name='Count',
+                                        data_set=dvs.data_set)
+        FormDataElement.objects.create(data_value_set=dvs, data_element=de,
+                                       form_field='count')
+        uuids = ['uuid%d' % i for i in range(12)]
+        self.locations = dict([(uuid, 'ou-shared') for uuid in uuids])
+        for uuid in uuids:
+            DataQueue.objects.create(service=self.service, data_id=uuid)
+        summary = utils.DataQueueProcessor(
+            chunk_size=2, batch=utils.DataValueSetBatch(max_sets=1),
+            concurrency=4).run()
+        self.assertEqual(summary['processed'], 12)
+        self.assertEqual(summary['batches'], 36)
+        self.assertEqual(len(self.fetched), 6)
+        sent = [uuid for xml in self.sent for uuid in uuids
+                if 'value="%s"' % uuid in xml]
+        self.assertEqual(sent, uuids)
+
+    def test_streamed_payload_matches_rendered_payload(self):
+        DataQueue.objects.create(service=self.service, data_id='uuid1')
+        utils.process_data_queue()
+        DataQueue.objects.update(processed=False)
+        SentPayload.objects.all().delete()
+        with override_settings(DHIS2_SERIALIZER='stream'):
+            utils.process_data_queue()
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.sent[0], self.sent[1])
+
+    def test_items_leased_to_other_workers_are_skipped(self):
+        now = datetime.now()
+        DataQueue.objects.create(service=self.service, data_id='uuid1',
+                                 leased_by='other',
+                                 lease_expires=now + timedelta(minutes=5))
+        DataQueue.objects.create(service=self.service, data_id='uuid2',
+                                 leased_by='crashed',
+                                 lease_expires=now - timedelta(minutes=5))
+        DataQueue.objects.create(service=self.service, data_id='uuid3')
+        summary = utils.DataQueueProcessor(claim_size=1).run()
+        self.assertEqual(self.fetched, [['uuid2'], ['uuid3']])
+        self.assertEqual(summary['processed'], 2)
+        self.assertEqual(DataQueue.objects.filter(
+            leased_by__isnull=False).count(), 1)
+        self.assertEqual(utils.release_expired_leases(), 0)
+        DataQueue.objects.filter(data_id='uuid1').update(
+            lease_expires=now - timedelta(seconds=1))
+        self.assertEqual(utils.release_expired_leases(), 1)
+        self.assertFalse(DataQueue.objects.get(data_id='uuid1').leased_by)
+
+    def test_failed_items_retried_with_backoff(self):
+        self.status = 500
+        self.import_summary = 'Internal Server Error'
+        DataQueue.objects.create(service=self.service, data_id='uuid1')
+        summary = utils.process_data_queue()
+        self.assertEqual(summary['failed'], 1)
+        dq = DataQueue.objects.get(data_id='uuid1')
+        self.assertEqual(dq.status, DataQueue.STATUS_FAILED)
+        self.assertEqual(dq.attempts, 1)
+        self.assertTrue(dq.next_attempt_on > datetime.now())
+        # not due yet
+        self.status = 200
+        self.import_summary = DataQueueProcessing.import_summary
+        self.assertEqual(utils.process_data_queue()['processed'], 0)
+        DataQueue.objects.update(next_attempt_on=datetime.now())
+        self.assertEqual(utils.process_data_queue()['processed'], 1)
+        dq = DataQueue.objects.get(data_id='uuid1')
+        self.assertEqual((dq.attempts, dq.next_attempt_on), (0, None))
+
+    def test_items_become_dead_letters_after_max_attempts(self):
+        DataQueue.objects.create(service=self.service, data_id='missing',
+                                 attempts=2)
+        with override_settings(DATA_QUEUE_MAX_ATTEMPTS=3):
+            summary = utils.process_data_queue()
+        self.assertEqual(summary['dead'], 1)
+        dq = DataQueue.objects.get(data_id='missing')
+        self.assertEqual(dq.status, DataQueue.STATUS_DEAD)
+        self.assertEqual(dq.next_attempt_on, None)
+        self.assertEqual(utils.process_data_queue()['missing'], 0)
+
+    def test_circuit_breaker_stops_requests_to_failing_dhis2(self):
+        self.status = 503
+        for uuid in ['uuid1', 'uuid2', 'uuid3']:
+            DataQueue.objects.create(service=self.service, data_id=uuid)
+        with override_settings(DHIS2_BREAKER_THRESHOLD=2):
+            summary = utils.DataQueueProcessor(
+                batch=utils.DataValueSetBatch(max_sets=1)).run()
+        self.assertEqual(len(self.sent), 2)
+        # the rest of the claim is neither rendered nor charged an attempt
+        self.assertEqual((summary['failed'], summary['postponed']), (1, 0))
+        self.assertTrue(summary['circuit_open'])
+        self.assertEqual(DataQueue.objects.filter(
+            attempts=0, leased_by__isnull=True).count(), 2)
+        summary = utils.process_data_queue()
+        self.assertTrue(summary['circuit_open'])
+        self.assertEqual(len(self.sent), 2)
+
+    def test_sets_refused_by_circuit_breaker_postponed(self):
+        DataQueue.objects.create(service=self.service, data_id='uuid1')
+        processor = utils.DataQueueProcessor()
+        for dq in processor.claim_items():
+            processor.process_item(dq)
+        breaker = utils.get_dhis2_circuit_breaker()
+        for i in range(breaker.threshold):
+            breaker.record_failure()
+        processor.flush()
+        self.assertEqual(self.sent, [])
+        self.assertEqual(processor.summary['postponed'], 1)
+        dq = DataQueue.objects.get(data_id='uuid1')
+        self.assertEqual((dq.processed, dq.attempts), (False, 0))
+        self.assertTrue(dq.next_attempt_on > datetime.now())
+        self.assertEqual(dq.leased_by, None)
+
+    def test_unchanged_resubmissions_not_sent(self):
+        dvs = DataValueSet.objects.get(data_set__data_set_id='ds0')
+        de = DataElement.objects.create(data_element_id='de1', name='Count',
+                                        data_set=dvs.data_set)
+        FormDataElement.objects.create(data_value_set=dvs, data_element=de,
+                                       form_field='count')
+        DataQueue.objects.create(service=self.service, data_id='uuid1')
+        utils.process_data_queue()
+        self.assertEqual(SentPayload.objects.count(), 3)
+        # re-posted by Formhub without changes
+        DataQueue.objects.update(processed=False)
+        self.sent = []
+        summary = utils.process_data_queue()
+        self.assertEqual(self.sent, [])
+        self.assertEqual((summary['processed'], summary['unchanged'],
+                          summary['skipped_sets']), (1, 1, 3))
+        # only the changed set is sent
+        DataQueue.objects.update(processed=False)
+        self.locations = {'uuid1': 'ou-uuid1'}
+        self._record = lambda uuid: dict(
+            DataQueueProcessing._record(self, uuid), count='changed')
+        summary = utils.process_data_queue()
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0].count('<dataValueSet '), 1)
+        self.assertTrue('value="changed"' in self.sent[0])
+        self.assertEqual(summary['skipped_sets'], 2)
+        self.assertEqual(SentPayload.objects.count(), 3)
+
+    def test_rejected_sets_sent_again(self):
+        self.status = 500
+        DataQueue.objects.create(service=self.service, data_id='uuid1')
+        utils.process_data_queue()
+        self.assertFalse(SentPayload.objects.exists())
+
+    def test_pushed_submissions_not_fetched(self):
+        DataQueue.objects.create(service=self.service, data_id='uuid1',
+                                 payload=json.dumps(self._record('uuid1')))
+        DataQueue.objects.create(service=self.service, data_id='uuid2')
+        summary = utils.process_data_queue()
+        self.assertEqual(self.fetched, [['uuid2']])
+        self.assertEqual((summary['pushed'], summary['processed']), (1, 2))
+        self.assertEqual(sum([xml.count('"ou-uuid1"')
+                              for xml in self.sent]), 3)
+        dq = DataQueue.objects.get(data_id='uuid1')
+        self.assertTrue(dq.processed)
+        self.assertEqual(dq.payload, None)
+
+    def test_item_pushed_again_while_sent_left_pending(self):
+        DataQueue.objects.create(service=self.service, data_id='uuid1',
+                                 payload=json.dumps(self._record('uuid1')))
+        processor = utils.DataQueueProcessor()
+        items = processor.claim_items()
+        # an edit is pushed while the run holds the item, a run for it is
+        # already pending
+        cache.set(tasks.get_pending_run_key(self.service.pk), True)
+        edited = dict(self._record('uuid1'), count='edited')
+        User.objects.create_user('bob', password='bob')
+        self.client.login(username='bob', password='bob')
+        response = self.client.post(
+            reverse(views.initiate_formhub_request,
+                    kwargs={'id_string': 'dhis2form'}),
+            json.dumps(edited), content_type='application/json')
+        self.assertEqual(json.loads(response.content)['status'], True)
+        for dq in items:
+            processor.process_item(dq)
+        processor.flush()
+        processor.release_items()
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual((processor.summary['processed'],
+                          processor.summary['superseded']), (0, 1))
+        dq = DataQueue.objects.get(data_id='uuid1')
+        self.assertFalse(dq.processed)
+        self.assertEqual(json.loads(dq.payload), edited)
+        self.assertEqual(dq.leased_by, None)
+        cache.clear()
+
+    def test_page_concurrency_capped(self):
+        User.objects.create_user('bob', password='bob')
+        client = Client()
+        client.login(username='bob', password='bob')
+        runs = []
+        process_data_queue = views.process_data_queue
+
+        def fake_process_data_queue(concurrency=None):
+            runs.append(concurrency)
+            return process_data_queue()
+        views.process_data_queue = fake_process_data_queue
+        try:
+            with override_settings(DATA_QUEUE_MAX_CONCURRENCY=4):
+                for concurrency in ('2', '1000'):
+                    client.get(reverse(views.process_dataqueue),
+                               {'concurrency': concurrency})
+        finally:
+            views.process_data_queue = process_data_queue
+        self.assertEqual(runs, [2, 4])
+
+    def test_stage_timings_per_run_and_service(self):
+        other = _create_service('other')
+        DataValueSet.objects.create(
+            service=other, data_set=DataSet.objects.get(data_set_id='ds0'))
+        for service, uuid in [(self.service, 'uuid1'),
+                              (self.service, 'uuid2'), (other, 'uuid3')]:
+            DataQueue.objects.create(service=service, data_id=uuid)
+        summary = utils.process_data_queue()
+        counts = dict([(stage, histogram['count']) for stage, histogram
+                       in summary['stages'].items()])
+        self.assertEqual(counts, {'fetch': 2, 'load_dict': 7, 'render': 7,
+                                  'send': 1})
+        self.assertEqual(summary['services'][other.pk]['load_dict']['count'],
+                         1)
+        self.assertEqual(
+            summary['services'][self.service.pk]['send']['count'], 1)
+        fetch = summary['stages']['fetch']
+        self.assertEqual(sum([c for b, c in fetch['buckets']]), 2)
+        self.assertTrue(fetch['p50'] <= fetch['p99'])
+        # the queue page shows them
+        User.objects.create_user('bob', password='bob')
+        client = Client()
+        client.login(username='bob', password='bob')
+        DataQueue.objects.update(processed=False)
+        SentPayload.objects.all().delete()
+        response = client.get(reverse(views.process_dataqueue))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('load_dict' in response.content)
+        self.assertTrue('other' in response.content)
+
+    def test_backfill_pages_through_submissions(self):
+        summary = utils.FormhubBackfill(self.service, page_size=3).run()
+        self.assertEqual(self.fetched, [0, 3, 6])
+        self.assertEqual((summary['records'], summary['processed']), (7, 7))
+        self.assertEqual((summary['sets'], summary['pages']), (21, 3))
+        self.assertEqual(summary['next_offset'], 7)
+        self.assertEqual(sum([xml.count('<dataValueSet ')
+                              for xml in self.sent]), 21)
+        self.assertEqual(summary['stages']['fetch']['count'], 3)
+        self.assertEqual(
+            summary['services'][self.service.pk]['render']['count'], 21)
+        self.assertFalse(DataQueue.objects.exists())
+
+    def test_backfill_queues_rejected_records(self):
+        self.import_summary = (
+            '<importSummary><status>WARNING</status><conflicts>'
+            '<conflict object="ou-uuid4" value="Org unit not found" />'
+            '</conflicts></importSummary>')
+        summary = utils.FormhubBackfill(
+            self.service, page_size=2, concurrency=3, offset=1,
+            batch=utils.DataValueSetBatch(max_sets=2)).run()
+        # pages are requested ahead, past the end too
+        self.assertEqual(sorted(self.fetched), [1, 3, 5, 7, 9, 11])
+        self.assertEqual((summary['processed'], summary['failed']), (5, 1))
+        dq = DataQueue.objects.get()
+        self.assertEqual((dq.data_id, dq.status),
+                         ('uuid4', DataQueue.STATUS_FAILED))
+        self.assertTrue(dq.next_attempt_on > datetime.now())
+
+    def test_backfill_resumes_after_last_acknowledged_batch(self):
+        class Crash(BaseException):
+            pass
+
+        def crash_on_fourth(*args, **kwargs):
+            if len(self.sent) == 3:
+                raise Crash()
+            return self._fake_send_to_dhis2(*args, **kwargs)
+        utils.send_to_dhis2 = crash_on_fourth
+        # one record's sets per batch
+        batch = utils.DataValueSetBatch(max_sets=3)
+        self.assertRaises(Crash, utils.FormhubBackfill(
+            self.service, page_size=3, batch=batch).run)
+        checkpoint = BackfillCheckpoint.objects.get(service=self.service)
+        self.assertEqual((checkpoint.offset, checkpoint.finished_on), (3, None))
+        utils.send_to_dhis2 = self._fake_send_to_dhis2
+        self.fetched, self.sent = [], []
+        summary = utils.FormhubBackfill(
+            self.service, page_size=3, batch=batch.copy()).run()
+        self.assertEqual(self.fetched, [3, 6])
+        self.assertEqual([[uuid for uuid in ['uuid%d' % i for i in range(7)]
+                           if '"ou-%s"' % uuid in xml] for xml in self.sent],
+                         [['uuid3'], ['uuid4'], ['uuid5'], ['uuid6']])
+        self.assertEqual(summary['next_offset'], 7)
+        checkpoint = BackfillCheckpoint.objects.get(service=self.service)
+        self.assertEqual(checkpoint.offset, 7)
+        self.assertTrue(checkpoint.finished_on)
+        # a finished backfill starts over
+        self.assertEqual(utils.FormhubBackfill(self.service).offset, 0)
+
+    def test_backfill_command(self):
+        out = StringIO()
+        call_command('backfill_formhub', 'dhis2form', page_size=5,
+                     stdout=out)
+        self.assertTrue('7 records in' in out.getvalue())
+        self.assertTrue('7 sent, 0 queued for retry, 21 data value sets'
+                        in out.getvalue())
+
+
+class MappingPlan(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.dvs = _create_data_value_set(
+            _create_service(), frequency=DataSet.FREQUENCY_MONTHLY)
+        self.ds = self.dvs.data_set
+        for i, field in enumerate(['births', 'deaths', 'births']):
+            de = DataElement.objects.create(
+                data_element_id='de%d' % i, name='Element %d' % i,
+                data_set=self.ds)
+            FormDataElement.objects.create(
+                data_value_set=self.dvs, data_element=de, form_field=field)
+        self.record = {'period': '2013-01-15', 'location': 'ou1',
+                       'births': '3', 'deaths': '1'}
+
+    def tearDown(self):
+        cache.clear()
+
+    def _render(self, dvs=None):
+        if dvs is None:
+            dvs = DataValueSet.objects.get(pk=self.dvs.pk)
+        return utils.DataValueSetInterface(dvs, self.record).load_dict()
+
+    def test_plan_built_with_one_query_per_instance(self):
+        dvs = DataValueSet.objects.get(pk=self.dvs.pk)
+        with self.assertNumQueries(1):
+            values = self._render(dvs)
+        self.assertEqual(values['dataSet'], 'ds0')
+        self.assertEqual(values['period'], '201301')
+        self.assertEqual(values['dataElements'], [
+            {'id': 'de0', 'value': '3'}, {'id': 'de2', 'value': '3'},
+            {'id': 'de1', 'value': '1'}])
+        with self.assertNumQueries(0):
+            self.assertEqual(self._render(dvs), values)
+
+    def test_changes_picked_up_by_new_instances(self):
+        self._render()
+        FormDataElement.objects.filter(form_field='deaths').delete()
+        self.assertEqual(len(self._render()['dataElements']), 2)
+        DataElement.objects.filter(data_element_id='de0').update(
+            data_element_id='renamed')
+        de = DataElement.objects.get(data_element_id='renamed')
+        de.save()
+        self.assertEqual(self._render()['dataElements'][0]['id'], 'renamed')
+        self.ds.frequency = DataSet.FREQUENCY_YEARLY
+        self.ds.save()
+        self.assertEqual(self._render()['period'], '2013')
+
+
+class FormFieldIndex(TestCase):
+    form = {'name': 'dhis2form', 'children': [
+        {'name': 'period', 'type': 'date', 'label': 'Period'},
+        {'name': 'clinic', 'type': 'group', 'label': 'Clinic', 'children': [
+            {'name': 'births', 'type': 'integer', 'label': 'Births'},
+            {'name': 'visits', 'type': 'repeat', 'children': [
+                {'name': 'reason', 'type': 'text'}]}]}]}
+
+    def setUp(self):
+        cache.clear()
+        self.loads = 0
+        self._loads = models.simplejson.loads
+        models.simplejson.loads = self._counting_loads
+        self.service = _create_service(json=json.dumps(self.form))
+
+    def tearDown(self):
+        models.simplejson.loads = self._loads
+        cache.clear()
+
+    def _counting_loads(self, *args, **kwargs):
+        self.loads += 1
+        return self._loads(*args, **kwargs)
+
+    def test_nested_fields_indexed_with_full_paths(self):
+        index = self.service.get_field_index()
+        self.assertEqual([(f['path'], f['repeat']) for f in index], [
+            ('period', None), ('clinic/births', None),
+            ('clinic/visits/reason', 'clinic/visits')])
+        self.assertEqual(self.service.get_form_fields(), (
+            ('period', 'Period'), ('clinic/births', 'Births')))
+
+    def test_form_parsed_once_until_it_changes(self):
+        self.service.get_form_fields()
+        FormhubService.objects.get(pk=self.service.pk).get_form_fields()
+        self.service.get_form_fields()
+        self.assertEqual(self.loads, 1)
+        self.service.json = json.dumps({'children': [{'name': 'x'}]})
+        self.assertEqual(self.service.get_form_fields(), (('x', 'x'),))
+        self.assertEqual(self.loads, 2)
+
+
+class FormChoices(TestCase):
+    """
+    Also measures how long the WSGI app, with its URLconf, and the Celery
+    tasks take to import, checking that importing them runs no queries.
+    """
+    startup_script = """
+import os, sys, time
+os.environ['DJANGO_SETTINGS_MODULE'] = 'f2dhis2.settings'
+from django.db import connection
+connection.use_debug_cursor = True
+start = time.time()
+for name in sys.argv[1:]:
+    __import__(name)
+print len(connection.queries), time.time() - start
+"""
+
+    def setUp(self):
+        cache.clear()
+        self.dvs = _create_data_value_set(_create_service())
+        self.ds = self.dvs.data_set
+
+    def tearDown(self):
+        cache.clear()
+
+    def _choices(self, name):
+        return list(FHDataElementForm().fields[name].choices)[1:]
+
+    def test_choices_looked_up_per_form(self):
+        self.assertEqual(self._choices('dvs'),
+                         [(self.dvs.pk, u'%s' % self.dvs)])
+        # one query per choice field, whichever process changed the models
+        with self.assertNumQueries(2):
+            FHDataElementForm()
+        de = DataElement.objects.create(data_element_id='de0', name='DE',
+                                        data_set=self.ds)
+        self.assertEqual(self._choices('data_elements'),
+                         [(de.pk, u'%s' % de)])
+        self.ds.name = 'Renamed'
+        self.ds.save()
+        self.assertTrue('Renamed' in self._choices('dvs')[0][1])
+        self.dvs.delete()
+        self.assertEqual(self._choices('dvs'), [])
+
+    def test_no_queries_at_import(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for label, modules in (
+                ('WSGI app', ['f2dhis2.wsgi', 'f2dhis2.urls', 'main.forms']),
+                ('Celery worker', ['main.tasks'])):
+            output = subprocess.check_output(
+                [sys.executable, '-c', self.startup_script] + modules,
+                cwd=root)
+            queries, seconds = output.split()[-2:]
+            sys.stderr.write("\n%s import: %.3fs, %s queries\n"
+                             % (label, float(seconds), queries))
+            self.assertEqual(queries, '0')
+
+
+class DataSetImport(TestCase):
+    def setUp(self):
+        self._load_from_dhis2 = forms.load_from_dhis2
+        forms.load_from_dhis2 = self._fake_load_from_dhis2
+        for i in range(3):
+            OrganizationUnit.objects.create(org_unit_id='ou%d' % i,
+                                            name='Org Unit %d' % i)
+
+    def tearDown(self):
+        forms.load_from_dhis2 = self._load_from_dhis2
+
+    def _fake_load_from_dhis2(self, url):
+        return 200, json.dumps({
+            'id': 'ds0', 'name': 'Data Set 0', 'periodType': 'Monthly',
+            'dataElements': [{'id': 'de%d' % i, 'name': 'Element %d' % i}
+                             for i in range(5)],
+            'organisationUnits': [{'id': 'ou%d' % i, 'name': 'Org Unit %d' % i}
+                                  for i in range(1, 11)]})
+
+    def _import(self):
+        form = forms.DataSetImportForm(
+            {'data_set_url': 'http://apps.dhis2.org/api/dataSets/ds0'})
+        return form.ds_import()
+
+    def test_data_set_imported_with_set_based_queries(self):
+        # data set, elements, existing org units, new org units, their
+        # pks and the data set's org units
+        with self.assertNumQueries(6):
+            summary = self._import()
+        self.assertEqual((summary['dataElements'], summary['orgUnits']),
+                         (5, 10))
+        ds = DataSet.objects.get(data_set_id='ds0')
+        self.assertEqual(ds.url, 'http://apps.dhis2.org/api/dataSets/ds0')
+        self.assertEqual(ds.dataelement_set.count(), 5)
+        self.assertEqual(sorted(ds.organizations.values_list(
+            'org_unit_id', flat=True)), sorted(['ou%d' % i
+                                                for i in range(1, 11)]))
+        self.assertEqual(OrganizationUnit.objects.count(), 11)
+
+    def test_org_units_looked_up_in_chunks(self):
+        # 10 ids looked up in 3 queries, the 8 new ones in 2
+        with override_settings(BULK_LOOKUP_CHUNK_SIZE=4):
+            with self.assertNumQueries(9):
+                self._import()
+        self.assertEqual(OrganizationUnit.objects.count(), 11)
+
+    def test_existing_data_set_reported(self):
+        self._import()
+        self.assertTrue('ds_status' in self._import())
+        self.assertEqual(DataElement.objects.count(), 5)
+
+
+class MetadataSync(TestCase):
+    def setUp(self):
+        self._load_from_dhis2 = utils.load_from_dhis2
+        self._get_dhis2_changes = utils.get_dhis2_changes
+        utils.load_from_dhis2 = self._fake_load_from_dhis2
+        utils.get_dhis2_changes = self._fake_get_dhis2_changes
+        self.changes_since = []
+        self.changes = {'dataElements': [], 'organisationUnits': []}
+        self.ds = DataSet.objects.create(
+            data_set_id='ds0', name='Data Set 0',
+            url='http://apps.dhis2.org/api/dataSets/ds0')
+        for i in range(2):
+            DataElement.objects.create(data_element_id='de%d' % i,
+                                       name='Element %d' % i, data_set=self.ds)
+        for i in range(3):
+            self.ds.organizations.add(OrganizationUnit.objects.create(
+                org_unit_id='ou%d' % i, name='Org Unit %d' % i))
+        self.document = {
+            'id': 'ds0', 'name': 'Data Set 0', 'periodType': 'Monthly',
+            'lastUpdated': '2013-05-02T10:11:12.345+0000',
+            'dataElements': [{'id': 'de0', 'name': 'Renamed'},
+                             {'id': 'de2', 'name': 'Element 2'}],
+            'organisationUnits': [{'id': 'ou1', 'name': 'Renamed'},
+                                  {'id': 'ou2', 'name': 'Org Unit 2'},
+                                  {'id': 'ou3', 'name': 'Org Unit 3'}]}
+
+    def tearDown(self):
+        utils.load_from_dhis2 = self._load_from_dhis2
+        utils.get_dhis2_changes = self._get_dhis2_changes
+
+    def _fake_load_from_dhis2(self, url):
+        if self.document is None:
+            return 500, ''
+        return 200, json.dumps(self.document)
+
+    def _fake_get_dhis2_changes(self, api_url, resource, since):
+        self.changes_since.append((api_url, resource, since))
+        return self.changes[resource]
+
+    def test_changed_data_set_synced(self):
+        summary = utils.sync_data_set(self.ds, datetime(2013, 5, 3))
+        self.assertEqual(
+            [summary[key] for key in ('elements_added', 'elements_renamed',
+                                      'elements_removed', 'org_units_added',
+                                      'org_units_renamed',
+                                      'org_units_removed')],
+            [1, 1, 1, 1, 1, 1])
+        self.assertEqual(sorted(self.ds.dataelement_set.values_list(
+            'data_element_id', 'name')),
+            [('de0', 'Renamed'), ('de2', 'Element 2')])
+        self.assertEqual(sorted(self.ds.organizations.values_list(
+            'org_unit_id', 'name')), [('ou1', 'Renamed'),
+                                      ('ou2', 'Org Unit 2'),
+                                      ('ou3', 'Org Unit 3')])
+        # removed from the data set only
+        self.assertTrue(OrganizationUnit.objects.filter(
+            org_unit_id='ou0').exists())
+        self.assertEqual(DataSet.objects.get(pk=self.ds.pk).last_synced_on,
+                         datetime(2013, 5, 3))
+        self.assertEqual(self.changes_since, [])
+
+    def test_only_changes_since_last_sync_applied(self):
+        self.ds.last_synced_on = datetime(2013, 6, 1)
+        self.ds.save()
+        self.changes['organisationUnits'] = [
+            {'id': 'ou2', 'name': 'Renamed'}, {'id': 'other', 'name': 'x'}]
+        summary = utils.sync_data_set(self.ds, datetime(2013, 6, 2))
+        self.assertFalse(summary['changed'])
+        self.assertEqual(self.changes_since, [
+            ('http://apps.dhis2.org/api', 'dataElements',
+             datetime(2013, 6, 1)),
+            ('http://apps.dhis2.org/api', 'organisationUnits',
+             datetime(2013, 6, 1))])
+        self.assertEqual(summary['org_units_renamed'], 1)
+        self.assertEqual(self.ds.organizations.count(), 3)
+        self.assertEqual(OrganizationUnit.objects.get(
+            org_unit_id='ou2').name, 'Renamed')
+
+    def test_timestamps_compared_in_utc(self):
+        for value, utc in [('2013-05-02T10:30:00.000+0200', 8),
+                           ('2013-05-02T10:30:00-05:00', 15),
+                           ('2013-05-02T10:30:00.000', 10)]:
+            self.assertEqual(utils.parse_dhis2_date(value),
+                             datetime(2013, 5, 2, utc, 30))
+        # 08:30 UTC, before the last sync
+        self.ds.last_synced_on = datetime(2013, 5, 2, 9, 0)
+        self.ds.save()
+        self.document['lastUpdated'] = '2013-05-02T10:30:00.000+0200'
+        self.assertFalse(utils.sync_data_set(self.ds)['changed'])
+        # 09:30 UTC, after it, whatever the server's TIME_ZONE
+        self.ds.last_synced_on = datetime(2013, 5, 2, 9, 0)
+        self.document['lastUpdated'] = '2013-05-02T11:30:00.000+0200'
+        self.assertTrue(utils.sync_data_set(self.ds)['changed'])
+        synced_on = DataSet.objects.get(pk=self.ds.pk).last_synced_on
+        self.assertTrue(abs(datetime.utcnow() - synced_on) < timedelta(
+            minutes=1))
+
+    def test_changes_requested_since_utc_watermark(self):
+        requested = []
+
+        class Client(object):
+            def request(self, url, headers=None):
+                requested.append(url)
+                return type('Response', (), {'status': 200})(), '{}'
+        _get_dhis2_client = utils.get_dhis2_client
+        utils.get_dhis2_client = Client
+        try:
+            self._get_dhis2_changes('http://apps.dhis2.org/api',
+                                    'dataElements', datetime(2013, 5, 2, 9))
+        finally:
+            utils.get_dhis2_client = _get_dhis2_client
+        self.assertTrue('lastUpdated=2013-05-02T09%3A00%3A00%2B0000'
+                        in requested[0])
+
+    def test_renames_applied_in_bulk(self):
+        current = dict(OrganizationUnit.objects.values_list('org_unit_id',
+                                                            'name'))
+        names = dict([('ou%d' % i, 'Renamed %d' % i) for i in range(3)])
+        names['ou3'] = 'Not imported'
+        with override_settings(BULK_LOOKUP_CHUNK_SIZE=6):
+            # a lookup and an UPDATE for each chunk of two rows
+            with self.assertNumQueries(4):
+                renamed = utils.rename_rows(
+                    OrganizationUnit.objects.all(), 'org_unit_id', current,
+                    names)
+        self.assertEqual(renamed, 3)
+        self.assertEqual(sorted(OrganizationUnit.objects.values_list(
+            'org_unit_id', 'name')), [('ou0', 'Renamed 0'),
+                                      ('ou1', 'Renamed 1'),
+                                      ('ou2', 'Renamed 2')])
+
+    def test_watermark_kept_when_dhis2_unavailable(self):
+        self.document = None
+        self.assertEqual(utils.sync_dhis2_metadata(), {'ds0': None})
+        self.assertEqual(DataSet.objects.get(pk=self.ds.pk).last_synced_on,
+                         None)
+        self.assertEqual(self.ds.dataelement_set.count(), 2)
+
+    def test_sync_command(self):
+        out = StringIO()
+        call_command('sync_dhis2_metadata', 'ds0', stdout=out)
+        self.assertTrue(out.getvalue().startswith(
+            'ds0: data elements 1 added, 1 renamed, 1 removed;'))
+
+
+class StreamingSerializer(TestCase):
+    values = {
+        'dataSet': 'ds&0', 'orgUnit': u"ou'\xe9", 'period': '201301',
+        'completeDate': '2013-01-15',
+        'dataElements': [{'id': 'de1', 'value': '<3>'},
+                         {'id': 'de2', 'value': None},
+                         {'id': 'de3', 'value': 4},
+                         {'id': 'de4'}]}
+
+    def _template_xml(self, values):
+        return utils.DataValueSetInterface(None).render(values)
+
+    def test_stream_matches_template_output(self):
+        for values in [self.values, {'dataSet': 'ds0', 'orgUnit': 'ou1'}]:
+            self.assertEqual(
+                u''.join(utils.iter_data_value_set_xml(values)),
+                self._template_xml(values))
+
+    def test_streamed_batch_matches_rendered_batch(self):
+        other = dict(self.values, orgUnit='ou2')
+        rendered = utils.get_data_value_sets_xml(
+            [self._template_xml(self.values), self._template_xml(other)])
+        streamed = u''.join(utils.iter_data_value_sets_xml(
+            [self.values, self._template_xml(other)]))
+        self.assertEqual(streamed, rendered)
+
+    def test_chunked_body(self):
+        body = ChunkedBody(lambda: iter([u'<a>', '', u'\xe9</a>']))
+        for attempt in range(2):
+            chunks = []
+            while True:
+                chunk = body.read(8192)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            self.assertEqual(chunks, ['3\r\n<a>\r\n', '6\r\n\xc3\xa9</a>\r\n',
+                                      '0\r\n\r\n'])
+            body.rewind()
+
+
+class QueueTrigger(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.scheduled = []
+        self._process_dqueue = tasks.process_dqueue
+        tasks.process_dqueue = self
+        self.service = _create_service()
+
+    def tearDown(self):
+        tasks.process_dqueue = self._process_dqueue
+        cache.clear()
+
+    def apply_async(self, kwargs=None, countdown=None):
+        self.scheduled.append(kwargs)
+
+    def test_webhook_burst_schedules_one_run(self):
+        for i in range(5):
+            response = self.client.get(reverse(
+                views.initiate_formhub_request,
+                kwargs={'id_string': 'dhis2form', 'uuid': 'uuid%d' % i}))
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(DataQueue.objects.count(), 5)
+        self.assertEqual(self.scheduled, [{'service_id': self.service.pk}])
+        # the run is only pending for the trigger delay, webhooks after it
+        # schedule another one
+        cache.delete(tasks.get_pending_run_key(self.service.pk))
+        self.assertTrue(tasks.schedule_process_dqueue(self.service))
+        self.assertEqual(len(self.scheduled), 2)
+
+    def test_pushed_submission_stored_with_the_item(self):
+        url = reverse(views.initiate_formhub_request,
+                      kwargs={'id_string': 'dhis2form'})
+        submission = {'_uuid': 'uuid1', 'count': 3}
+        # pushed values go to DHIS2 as they are, only users may push them
+        response = self.client.post(url, json.dumps(submission),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(DataQueue.objects.count(), 0)
+        User.objects.create_user('bob', password='bob')
+        response = self.client.post(url, json.dumps(submission),
+                                    content_type='application/json',
+                                    HTTP_AUTHORIZATION='Basic ' +
+                                    base64.b64encode('bob:bob'))
+        self.assertEqual(json.loads(response.content)['status'], True)
+        dq = DataQueue.objects.get(data_id='uuid1')
+        self.assertEqual(json.loads(dq.payload), submission)
+        self.assertEqual(self.scheduled, [{'service_id': self.service.pk}])
+        # without a body the submission is pulled from Formhub again
+        self.client.get(reverse(
+            views.initiate_formhub_request,
+            kwargs={'id_string': 'dhis2form', 'uuid': 'uuid1'}))
+        self.assertEqual(DataQueue.objects.get(pk=dq.pk).payload, None)
+        self.client.login(username='bob', password='bob')
+        for body in ['not json', '[]', '{}']:
+            response = self.client.post(url, body,
+                                        content_type='application/json')
+            self.assertEqual(json.loads(response.content)['status'], False)
+        # the body can't queue values under another submission's uuid
+        response = self.client.post(
+            reverse(views.initiate_formhub_request,
+                    kwargs={'id_string': 'dhis2form', 'uuid': 'uuid2'}),
+            json.dumps(submission), content_type='application/json')
+        self.assertEqual(json.loads(response.content)['status'], False)
+        self.assertEqual(DataQueue.objects.count(), 1)
+
+
+class QueueMetrics(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = _create_service()
+        User.objects.create_user('bob', password='bob')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_queue_depth_lag_and_throughput(self):
+        now = datetime.now()
+        DataQueue.objects.create(service=self.service, data_id='uuid1')
+        DataQueue.objects.create(service=self.service, data_id='uuid2',
+                                 status=DataQueue.STATUS_FAILED)
+        DataQueue.objects.create(service=self.service, data_id='uuid3',
+                                 status=DataQueue.STATUS_DEAD)
+        DataQueue.objects.create(service=self.service, data_id='uuid4',
+                                 processed=True, processed_on=now)
+        DataQueue.objects.filter(data_id='uuid1').update(
+            created_on=now - timedelta(minutes=5))
+        DataQueue.objects.filter(data_id='uuid3').update(
+            created_on=now - timedelta(days=5))
+        for status in [200, 200, 503, 418, None]:
+            metrics.record_dhis2_response(status)
+        # what the workers' runs publish
+        for queue_wait in (1.5, 0.25):
+            utils.publish_run_metrics({'dhis2_queue_wait': queue_wait,
+                                       'dhis2_limit': 4,
+                                       'circuit_open': False})
+        with self.assertNumQueries(4):
+            text = utils.get_metrics(now)
+        lines = text.splitlines()
+        labels = 'service="dhis2form",service_id="%d"' % self.service.pk
+        for status, count in [('pending', 1), ('failed', 1), ('dead', 1),
+                              ('missing', 0)]:
+            self.assertTrue('f2dhis2_queue_items{%s,status="%s"} %d' % (
+                labels, status, count) in lines)
+        self.assertTrue('f2dhis2_queue_oldest_item_age_seconds 300.0'
+                        in lines)
+        self.assertTrue('f2dhis2_queue_processed_last_minute 1' in lines)
+        for status, count in [('200', 2), ('503', 1), ('4xx', 1),
+                              ('error', 1), ('429', 0)]:
+            self.assertTrue('f2dhis2_dhis2_responses_total{status="%s"} %d'
+                            % (status, count) in lines)
+        self.assertTrue('f2dhis2_dhis2_queue_wait_seconds_total 1.75'
+                        in lines)
+        self.assertTrue('f2dhis2_dhis2_concurrency_limit 4' in lines)
+        self.assertTrue('f2dhis2_dhis2_circuit_open 0' in lines)
+        self.assertEqual(len([line for line in lines if line.startswith(
+            'f2dhis2_http_pool_connections_total{outcome=')]), 4)
+        # scrapers authenticate with Basic auth
+        url = reverse(views.metrics)
+        self.assertEqual(self.client.get(url).status_code, 401)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Basic ' +
+                                   base64.b64encode('bob:bob'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+
+class HttpPoolTest(TestCase):
+    def test_connections_reused_per_host(self):
+        pool = HttpPool(size=1, idle_timeout=30)
+        host = 'http://formhub.org'
+        http = pool.acquire(host)
+        pool.release(host, http)
+        self.assertTrue(pool.acquire(host) is http)
+        self.assertFalse(pool.acquire('http://apps.dhis2.org') is http)
+        # only one idle connection is kept per host
+        pool.release(host, http)
+        pool.release(host, pool.create())
+        stats = pool.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertEqual((stats['idle'], stats['discarded']), (1, 1))
+
+    def test_idle_connections_expire(self):
+        pool = HttpPool(size=1, idle_timeout=30)
+        host = 'http://formhub.org'
+        http = pool.acquire(host)
+        pool.release(host, http)
+        pool.idle[host] = [(http, pool.idle[host][0][1] - 60)]
+        self.assertFalse(pool.acquire(host) is http)
+        self.assertEqual(pool.get_stats()['expired'], 1)
+
+
+class DHIS2Throttling(TestCase):
+    def test_limit_halved_on_slow_or_overloaded_responses(self):
+        limiter = AdaptiveLimiter(minimum=1, maximum=4, latency_target=1)
+        limiter.acquire()
+        limiter.release(5)
+        self.assertEqual(limiter.get_stats()['limit'], 2)
+        limiter.acquire()
+        limiter.release(0.1, overloaded=True)
+        limiter.acquire()
+        limiter.release(0.1, overloaded=True)
+        self.assertEqual(limiter.get_stats()['limit'], 1)
+        # grows by one per limit's worth of good responses
+        for i in range(3):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertEqual(limiter.get_stats()['limit'], 2)
+        stats = limiter.get_stats()
+        self.assertEqual((stats['requests'], stats['decreases']), (6, 3))
+
+    def test_requests_wait_for_a_slot(self):
+        limiter = AdaptiveLimiter(minimum=1, maximum=1, latency_target=1)
+        limiter.acquire()
+        timer = threading.Timer(0.05, limiter.release, [0.05])
+        timer.start()
+        self.assertTrue(limiter.acquire() >= 0.04)
+        self.assertEqual(limiter.get_stats()['waits'], 1)
+
+    def test_token_bucket_paces_requests(self):
+        bucket = TokenBucket(rate=50, burst=1)
+        self.assertEqual(bucket.acquire(), 0)
+        waited = bucket.acquire() + bucket.acquire()
+        self.assertTrue(waited >= 0.03)
+        self.assertEqual(TokenBucket(rate=None).acquire(), 0)
+
+    def test_send_backs_off_when_dhis2_is_overloaded(self):
+        server = FakeDHIS2Server()
+        try:
+            server.status = 503
+            with override_settings(DHIS2_DATA_VALUE_SET_URL=server.url,
+                                   DHIS2_CONCURRENCY_MAX=8):
+                status, content = utils.send_to_dhis2('<dataValueSet />')
+                stats = utils.get_dhis2_throttle().get_stats()
+        finally:
+            server.close()
+        self.assertEqual(status, 503)
+        self.assertEqual((stats['limit'], stats['in_flight']), (4, 0))
+
+
+class MetadataCaching(TestCase):
+    def setUp(self):
+        self.server = FakeDHIS2Server()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_unchanged_metadata_revalidated(self):
+        url = self.server.url.replace('dataValueSets', 'dataSets/ds0.json')
+        with override_settings(DHIS2_METADATA_CACHE_TTL=60):
+            self.assertEqual(utils.load_from_dhis2(url),
+                             (200, '{"id": "ds0"}'))
+            # fresh, DHIS2 is not asked
+            self.assertEqual(utils.load_from_dhis2(url)[1], '{"id": "ds0"}')
+        self.assertEqual(self.server.gets, [None])
+        with override_settings(DHIS2_METADATA_CACHE_TTL=0):
+            self.assertEqual(utils.load_from_dhis2(url),
+                             (200, '{"id": "ds0"}'))
+            self.server.metadata = ('"v2"', '{"id": "ds0", "name": "B"}')
+            self.assertEqual(utils.load_from_dhis2(url)[1],
+                             '{"id": "ds0", "name": "B"}')
+        self.assertEqual(self.server.gets, [None, '"v1"', '"v1"'])
+        self.assertEqual(MetadataCache.objects.get().etag, '"v2"')
+
+    def test_least_recently_used_entries_evicted(self):
+        url = self.server.url.replace('dataValueSets', 'dataSets/ds%d.json')
+        with override_settings(DHIS2_METADATA_CACHE_MAX_SIZE=30):
+            for i in range(3):
+                utils.load_from_dhis2(url % i)
+            utils.load_from_dhis2(url % 1)
+            utils.load_from_dhis2(url % 3)
+        self.assertEqual(
+            sorted(MetadataCache.objects.values_list('url', flat=True)),
+            [url % 1, url % 3])
+
+
+class RenderBenchmark(TestCase):
+    """
+    Per-record cost of rendering a data value set with the shared compiled
+    template against compiling it for every record, as was done before.
+
+    Runs with 1000 records, set F2DHIS2_BENCHMARK_RECORDS=1000,100000 to
+    include larger runs.
+    """
+
+    class UncachedInterface(utils.DataValueSetInterface):
+        def load_template(self):
+            self.template = self.compile_template(self.template_name)
+
+    def setUp(self):
+        self.dvs = _create_data_value_set(_create_service())
+        self.values = {
+            'dataSet': 'ds0', 'orgUnit': 'ou1', 'period': '201301',
+            'completeDate': '2013-01-15',
+            'dataElements': [{'id': 'de%d' % i, 'value': i}
+                             for i in range(10)]}
+        self.sizes = [int(n) for n in os.environ.get(
+            'F2DHIS2_BENCHMARK_RECORDS', '1000').split(',')]
+
+    def _per_record(self, interface, records):
+        start = time.time()
+        for i in xrange(records):
+            interface(self.dvs).render(self.values)
+        return (time.time() - start) / records
+
+    def test_render_cost_per_record(self):
+        for records in self.sizes:
+            before = self._per_record(self.UncachedInterface, records)
+            after = self._per_record(utils.DataValueSetInterface, records)
+            sys.stderr.write(
+                "\nrender %d records: %.1fus/record compiling per record, "
+                "%.1fus/record with the shared template\n"
+                % (records, before * 1e6, after * 1e6))
+            self.assertTrue(after < before)
+
+
+class QueueBenchmark(TestCase):
+    """
+    Throughput of the queue processor against local Formhub and DHIS2
+    stand-ins, 200 records by default or F2DHIS2_BENCHMARK_RECORDS of them.
+    """
+    records = int(os.environ.get(
+        'F2DHIS2_BENCHMARK_RECORDS', '200').split(',')[-1])
+
+    def setUp(self):
+        utils.circuit_breakers.clear()
+
+    def test_queue_throughput(self):
+        for concurrency in (1, 4):
+            report = run_benchmark(self.records, services=2, data_sets=2,
+                                   latency=0.002, concurrency=concurrency,
+                                   batch_sets=50)
+            sys.stderr.write("\n%s\n" % format_report(report))
+            self.assertEqual(report['summary']['processed'], self.records)
+            self.assertTrue(report['p50'] <= report['p99'])
+            # claiming, fetching and sending are per chunk and batch
+            self.assertTrue(report['queries_per_record'] < 5)
+            DataQueue.objects.all().delete()
+            FormhubService.objects.all().delete()
+            DataSet.objects.all().delete()
+
+    def test_failures_retried_later(self):
+        report = run_benchmark(50, error_rate=0.2, seed=1)
+        summary = report['summary']
+        self.assertTrue(summary['failed'] + summary['fetch_failed'])
+        self.assertEqual(DataQueue.objects.filter(
+            status=DataQueue.STATUS_PROCESSED).count(), summary['processed'])
+        self.assertEqual(DataQueue.objects.filter(
+            next_attempt_on__isnull=False).count(),
+            50 - summary['processed'])
+
+
+class PayloadCodecs(TestCase):
+    """
+    Includes a benchmark of bytes on the wire and end-to-end throughput of
+    every codec against a local DHIS2 stand-in, 1000 sets per codec by
+    default or F2DHIS2_BENCHMARK_RECORDS of them.
+    """
+    values = {'dataSet': 'ds0', 'orgUnit': 'ou1', 'period': '201301',
+              'completeDate': '2013-01-15',
+              'dataElements': [{'id': 'de%d' % i, 'value': i}
+                               for i in range(10)]}
+
+    def setUp(self):
+        self.server = FakeDHIS2Server()
+
+    def tearDown(self):
+        self.server.close()
+
+    def _batch(self, codec, gzip, sets):
+        batch = utils.DataValueSetBatch(
+            max_sets=sets + 1, max_bytes=sys.maxint,
+            codec=utils.PAYLOAD_CODECS[codec](), gzip=gzip)
+        for i in xrange(sets):
+            values = dict(self.values, orgUnit='ou%d' % i)
+            xml = None
+            if batch.codec.prerender:
+                xml = utils.DataValueSetInterface(None).render(values)
+            batch.add(i, xml, values)
+        return batch
+
+    def test_json_payload(self):
+        with override_settings(DHIS2_DATA_VALUE_SET_URL=self.server.url):
+            results = self._batch('json', True, 2).send()
+        self.assertEqual([success for o, success, m in results],
+                         [True, True])
+        content_type, encoding, body = self.server.received[0]
+        self.assertEqual((content_type, encoding),
+                         ('application/json', 'gzip'))
+        payload = json.loads(zlib.decompress(body, 16 + zlib.MAX_WBITS))
+        self.assertEqual(len(payload['dataValueSets']), 2)
+        self.assertEqual(payload['dataValueSets'][1], {
+            'dataSet': 'ds0', 'orgUnit': 'ou1', 'period': '201301',
+            'completeDate': '2013-01-15',
+            'dataValues': [{'dataElement': 'de%d' % i, 'value': '%d' % i}
+                           for i in range(10)]})
+
+    def test_streamed_body_resent_whole_on_stale_connection(self):
+        self.server.keep_alive = False
+        expected = []
+        with override_settings(DHIS2_DATA_VALUE_SET_URL=self.server.url):
+            for i in range(3):
+                values = dict(self.values, orgUnit='ou%d' % i)
+                expected.append(u''.join(
+                    utils.iter_data_value_sets_xml([values])).encode('utf-8'))
+                batch = utils.DataValueSetBatch(
+                    codec=utils.XMLPayloadCodec(stream=True), gzip=False)
+                batch.add(i, None, values)
+                self.assertEqual([success for o, success, m in batch.send()],
+                                 [True])
+        self.assertEqual([body for c, e, body in self.server.received],
+                         expected)
+
+    def test_codec_per_target(self):
+        host = 'apps.dhis2.org'
+        with override_settings(DHIS2_TARGETS={host: {'CODEC': 'json'}}):
+            self.assertTrue(isinstance(utils.get_payload_codec(),
+                                       utils.JSONPayloadCodec))
+            self.assertTrue(isinstance(
+                utils.get_payload_codec('http://localhost/api'),
+                utils.XMLPayloadCodec))
+
+    def test_codecs_declare_prerender(self):
+        self.assertFalse(issubclass(utils.JSONPayloadCodec,
+                                    utils.XMLPayloadCodec))
+        self.assertEqual(
+            [utils.PAYLOAD_CODECS[codec](stream=stream).prerender
+             for codec in ('xml', 'json') for stream in (False, True)],
+            [True, False, False, False])
+
+    def test_codec_benchmark(self):
+        sets = int(os.environ.get('F2DHIS2_BENCHMARK_RECORDS',
+                                  '1000').split(',')[0])
+        sizes = {}
+        with override_settings(DHIS2_DATA_VALUE_SET_URL=self.server.url):
+            for codec in ('xml', 'json'):
+                for gzip in (False, True):
+                    start = time.time()
+                    self._batch(codec, gzip, sets).send()
+                    elapsed = time.time() - start
+                    sizes[(codec, gzip)] = len(self.server.received[-1][2])
+                    sys.stderr.write(
+                        "\n%s%s: %d bytes for %d sets, %.0f sets/s\n" % (
+                            codec, '+gzip' if gzip else '',
+                            sizes[(codec, gzip)], sets, sets / elapsed))
+        self.assertTrue(sizes[('json', False)] < sizes[('xml', False)])
+        self.assertTrue(sizes[('xml', True)] < sizes[('xml', False)])
@@ -1,19 +1,46 @@
 import base64
 import json
 
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
 from functools import wraps
+from itertools import groupby
+from multiprocessing.pool import AsyncResult, ThreadPool
+import Queue
+import random
+import re
+import socket
+import threading
+import time
 import urllib
+from urlparse import urlparse
+from uuid import uuid4
+from xml.etree import ElementTree
+import zlib
+from hashlib import md5
 from django.contrib.auth import authenticate
 from django.http import HttpResponse
-import httplib2
+from django.utils.encoding import force_text
+from django.utils.formats import localize
+from django.utils.html import escape
+from django.utils.timezone import template_localtime
 import os.path
 
 from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Q
 from django.template.base import Template
 from django.template.context import Context
 
-from main.models import DataValueSet, DataSet, DataQueue
+from main.clients import (AdaptiveLimiter, ChunkedBody, CircuitBreaker,
+                          TokenBucket, get_dhis2_client, get_formhub_client,
+                          get_http_pool)
+from main.metrics import (StageMetrics, format_metrics, get_counters,
+                          get_dhis2_response_counts, get_gauge, incr_counter,
+                          record_dhis2_response, set_gauge)
+from main.models import (BackfillCheckpoint, DataElement, DataValueSet,
+                         DataSet, DataQueue, FormhubService, MetadataCache,
+                         OrganizationUnit, SentPayload)
 
 
 class DataValueSetInterface(object):
@@ -22,40 +49,58 @@ class DataValueSetInterface(object):
     dataValueSet = None
     data = {}
     data_elements = []
+    # compiled templates by name, shared by every instance in the process
+    templates = {}
+    templates_lock = threading.Lock()
 
     def __init__(self, dataValueSet, data=None):
         self.dataValueSet = dataValueSet
         self.data = data
         self.load_template()
 
-    def load_template(self):
+    @classmethod
+    def compile_template(cls, template_name):
         filename = os.path.abspath(os.path.join(
-            os.path.dirname(__file__), "templates/%s" % self.template_name))
+            os.path.dirname(__file__), "templates/%s" % template_name))
         f = open(filename)
-        self.template = Template(f.read())
+        template = Template(f.read())
         f.close()
+        return template
+
+    def load_template(self):
+        template = self.templates.get(self.template_name)
+        if template is None:
+            with self.templates_lock:
+                template = self.templates.get(self.template_name)
+                if template is None:
+                    template = self.compile_template(self.template_name)
+                    self.templates[self.template_name] = template
+        self.template = template
 
     def load_data_elements(self):
         elements = []
         if self.data is not None:
-            for fe in self.dataValueSet.formdataelement_set.all():
-                if self.data.has_key('%s' % fe.form_field):
-                    element = {'id': fe.data_element.data_element_id,
-                               'value': self.data['%s' % fe.form_field]}
-                    elements.append(element)
+            plan = self.dataValueSet.get_mapping_plan()
+            for form_field, data_element_ids in plan['fields']:
+                if self.data.has_key(form_field):
+                    for data_element_id in data_element_ids:
+                        element = {'id': data_element_id,
+                                   'value': self.data[form_field]}
+                        elements.append(element)
         self.data_elements = elements
 
     def get_period(self):
         # period = self.data['period']
         strdate = datetime.strptime(self.data['period'], '%Y-%m-%d')
-        if self.dataValueSet.data_set.frequency == DataSet.FREQUENCY_YEARLY:
+        frequency = self.dataValueSet.get_mapping_plan()['frequency']
+        if frequency == DataSet.FREQUENCY_YEARLY:
             period = strdate.strftime("%Y")
-        elif self.dataValueSet.data_set.frequency == DataSet.FREQUENCY_MONTHLY:
+        elif frequency == DataSet.FREQUENCY_MONTHLY:
             period = strdate.strftime("%Y%m")
-        elif self.dataValueSet.data_set.frequency == DataSet.FREQUENCY_WEEKLY:
+        elif frequency == DataSet.FREQUENCY_WEEKLY:
             period =  "%s%s" % (strdate.strftime("%Y"),
                                 strdate.isocalendar()[1])
-        elif self.dataValueSet.data_set.frequency == DataSet.FREQUENCY_DAILY:
+        elif frequency == DataSet.FREQUENCY_DAILY:
             period = strdate.strftime("%Y%m%d")
         else:
             period = strdate.strftime("%Y%m%d")
@@ -70,7 +115,7 @@ class DataValueSetInterface(object):
 
     def load_dict(self):
         rs = {
-            'dataSet': self.dataValueSet.data_set.data_set_id,
+            'dataSet': self.dataValueSet.get_mapping_plan()['data_set_id'],
             'orgUnit': self.get_organization_unit()
         }
         if self.data is not None and len(self.data):
@@ -80,8 +125,10 @@ class DataValueSetInterface(object):
             rs['dataElements'] = self.data_elements
         return rs
 
-    def render(self):
-        return self.template.render(Context(self.load_dict()))
+    def render(self, values=None):
+        if values is None:
+            values = self.load_dict()
+        return self.template.render(Context(values))
 
 
 def get_data_value_set_xml(dataValueSet, data=None):
@@ -89,16 +136,55 @@ def get_data_value_set_xml(dataValueSet, data=None):
     return dvsi.render()
 
 
-def get_data_from_formub(dataValueSet, id=None):
+def iter_data_value_set_xml(values, declaration=True):
+    """
+    yields the datavalueset.xml document for a DataValueSetInterface values
+    dict piece by piece, the pieces join to exactly what rendering the
+    template gives
+    """
+    def render(d, key):
+        # missing variables render as an empty string in the template
+        if key not in d:
+            return u''
+        # what the template does with {{ variable }}
+        return escape(force_text(localize(template_localtime(d[key]))))
+
+    if declaration:
+        yield u"<?xml version='1.0' encoding='UTF-8'?>\n"
+    yield (u'<dataValueSet xmlns="http://dhis2.org/schema/dxf/2.0" '
+           u'period="%s" orgUnit="%s" dataSet="%s" completeDate="%s">\n'
+           u'    <dataValues>\n    ' % (
+               render(values, 'period'), render(values, 'orgUnit'),
+               render(values, 'dataSet'), render(values, 'completeDate')))
+    for element in values.get('dataElements', []):
+        yield (u'\n        <dataValue dataElement="%s" value="%s" />\n    '
+               % (render(element, 'id'), render(element, 'value')))
+    yield u'\n    </dataValues>\n</dataValueSet>'
+
+
+def estimate_data_value_set_size(values):
+    """
+    returns roughly how many characters the document for values takes
+    """
+    size = 250
+    for element in values.get('dataElements', []):
+        size += 50 + len(u"%s%s" % (element.get('id'), element.get('value')))
+    return size
+
+
+def get_formhub_data_api_url(service, params=''):
+    url = service.url
+    if url.endswith('/form.json'):
+        url = url.replace('/form.json', '')
+    return url + u"/api?" + params
+
+
+def get_data_from_formub(service, id=None):
     params = ''
     if id is not None:
         params = urllib.urlencode({'query': '{"_uuid": "%s"}' % id})
-    url = dataValueSet.service.url
-    if url.endswith('/form.json'):
-        url = url.replace('/form.json', '')
-    data_api_path = url + u"/api?" + params
-    http = httplib2.Http()
-    req, content = http.request(data_api_path, 'GET')
+    data_api_path = get_formhub_data_api_url(service, params)
+    req, content = get_formhub_client().request(data_api_path, 'GET')
     if req.status == 200:
         try:
             return json.loads(content)
@@ -108,35 +194,816 @@ def get_data_from_formub(dataValueSet, id=None):
     return None
 
 
-def send_to_dhis2(xml):
-    auth = base64.encodestring(settings.DHIS2_USERNAME + ':' +
-                               settings.DHIS2_PASSWORD)
-    headers = {"Content-Type": "application/xml",
-               'Authorization': 'Basic ' + auth}
-    http = httplib2.Http()
-    http.add_credentials(settings.DHIS2_USERNAME, settings.DHIS2_PASSWORD)
-    resp, content = http.request(
-        settings.DHIS2_DATA_VALUE_SET_URL, 'POST', body=xml, headers=headers)
-    return resp.status, content
+def get_submissions_from_formhub(service, uuids):
+    """
+    returns Formhub records for the given uuids as a dict of uuid => list
+    of records, fetched with a single `$in` query; uuids Formhub does not
+    know about are absent from the dict, None is returned if the request
+    fails
+    """
+    params = urllib.urlencode(
+        {'query': json.dumps({'_uuid': {'$in': list(uuids)}})})
+    data_api_path = get_formhub_data_api_url(service, params)
+    req, content = get_formhub_client().request(data_api_path, 'GET')
+    if req.status != 200:
+        return None
+    records = {}
+    for record in json.loads(content):
+        records.setdefault(record.get('_uuid'), []).append(record)
+    return records
+
+
+def get_submission_page(service, start, limit):
+    """
+    returns up to limit Formhub records of a service in submission order,
+    skipping the first start ones, or None if the request fails
+    """
+    params = urllib.urlencode({'start': start, 'limit': limit,
+                               'sort': json.dumps({'_id': 1})})
+    data_api_path = get_formhub_data_api_url(service, params)
+    req, content = get_formhub_client().request(data_api_path, 'GET')
+    if req.status != 200:
+        return None
+    return json.loads(content)
+
+
+def get_dhis2_target_option(name, url=None):
+    """
+    returns the DHIS2_<name> setting for the DHIS2 instance at url, which
+    defaults to settings.DHIS2_DATA_VALUE_SET_URL, applying the instance's
+    overrides from settings.DHIS2_TARGETS
+    """
+    host = urlparse(url or settings.DHIS2_DATA_VALUE_SET_URL).netloc
+    target = settings.DHIS2_TARGETS.get(host, {})
+    if name in target:
+        return target[name]
+    return getattr(settings, 'DHIS2_%s' % name)
+
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+
+def get_dhis2_circuit_breaker(url=None):
+    """
+    returns the process wide circuit breaker of the DHIS2 instance at url
+    """
+    host = urlparse(url or settings.DHIS2_DATA_VALUE_SET_URL).netloc
+    with circuit_breakers_lock:
+        if host not in circuit_breakers:
+            circuit_breakers[host] = CircuitBreaker(
+                get_dhis2_target_option('BREAKER_THRESHOLD', url),
+                get_dhis2_target_option('BREAKER_RESET_TIMEOUT', url))
+        return circuit_breakers[host]
+
+
+class DHIS2Throttle(object):
+    """
+    Paces requests to a DHIS2 instance with a TokenBucket of
+    DHIS2_RATE_LIMIT requests per second and bounds the requests in flight
+    with an AdaptiveLimiter between DHIS2_CONCURRENCY_MIN and
+    DHIS2_CONCURRENCY_MAX that backs off on responses slower than
+    DHIS2_LATENCY_TARGET seconds and on 429 and 503 responses.
+
+    The status of every response is counted for the metrics view.
+    """
+    bucket = None
+    limiter = None
+
+    def __init__(self, url=None):
+        self.bucket = TokenBucket(
+            get_dhis2_target_option('RATE_LIMIT', url),
+            get_dhis2_target_option('RATE_BURST', url))
+        self.limiter = AdaptiveLimiter(
+            get_dhis2_target_option('CONCURRENCY_MIN', url),
+            get_dhis2_target_option('CONCURRENCY_MAX', url),
+            get_dhis2_target_option('LATENCY_TARGET', url))
+        self.lock = threading.Lock()
+        self.rate_wait_time = 0.0
+
+    def request(self, send):
+        """
+        calls send() once allowed to, send returns a (status, content) pair
+        """
+        wait = self.bucket.acquire()
+        if wait:
+            with self.lock:
+                self.rate_wait_time += wait
+        self.limiter.acquire()
+        started = time.time()
+        status = None
+        try:
+            status, content = send()
+        finally:
+            self.limiter.release(time.time() - started,
+                                 status in (None, 429, 503))
+            record_dhis2_response(status)
+        return status, content
+
+    def get_stats(self):
+        """
+        returns the current concurrency limit, requests in flight and the
+        seconds requests spent waiting for the rate limit and for a slot
+        """
+        stats = self.limiter.get_stats()
+        with self.lock:
+            stats['rate_wait_time'] = self.rate_wait_time
+        stats['queue_wait_time'] = stats['wait_time'] + \
+            stats['rate_wait_time']
+        return stats
+
+
+throttles = {}
+throttles_lock = threading.Lock()
+
+
+def get_dhis2_throttle(url=None):
+    """
+    returns the process wide DHIS2Throttle of the DHIS2 instance at url
+    """
+    host = urlparse(url or settings.DHIS2_DATA_VALUE_SET_URL).netloc
+    with throttles_lock:
+        if host not in throttles:
+            throttles[host] = DHIS2Throttle(url)
+        return throttles[host]
+
+
+def send_to_dhis2(xml, content_type="application/xml",
+                  content_encoding=None):
+    """
+    posts a data value set document, xml may also be a function returning
+    the document's pieces, which are then sent as a chunked request body;
+    it is called again should the request have to be resent
+
+    Requests are paced and their concurrency limited by the instance's
+    DHIS2Throttle.
+    """
+    headers = {"Content-Type": content_type,
+               "Accept": "application/xml"}
+    if content_encoding is not None:
+        headers['Content-Encoding'] = content_encoding
+    if callable(xml):
+        xml = ChunkedBody(xml)
+        headers['Transfer-Encoding'] = 'chunked'
+
+    def send():
+        resp, content = get_dhis2_client().request(
+            settings.DHIS2_DATA_VALUE_SET_URL, 'POST', body=xml,
+            headers=headers)
+        return resp.status, content
+    return get_dhis2_throttle().request(send)
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_import_summaries(content):
+    """
+    returns a list of {'status': ..., 'conflicts': [(object, value), ...]}
+    dicts, one per importSummary in a DHIS2 import response
+    """
+    try:
+        root = ElementTree.fromstring(content)
+    except (ElementTree.ParseError, TypeError, ValueError):
+        return []
+    summaries = []
+    for node in root.iter():
+        if _local_name(node.tag) != 'importSummary':
+            continue
+        summary = {'status': None, 'conflicts': []}
+        for child in node.iter():
+            name = _local_name(child.tag)
+            if name == 'status' and summary['status'] is None:
+                summary['status'] = (child.text or '').strip().upper()
+            elif name == 'conflict':
+                summary['conflicts'].append(
+                    (child.get('object'), child.get('value')))
+        summaries.append(summary)
+    return summaries
+
+
+def get_data_value_sets_xml(documents):
+    """
+    wraps rendered dataValueSet documents in a single dataValueSets document
+    """
+    parts = [u"<?xml version='1.0' encoding='UTF-8'?>",
+             u'<dataValueSets xmlns="http://dhis2.org/schema/dxf/2.0">']
+    for xml in documents:
+        if xml.startswith(u'<?xml'):
+            xml = xml.split(u'\n', 1)[-1]
+        parts.append(xml)
+    parts.append(u'</dataValueSets>')
+    return u'\n'.join(parts)
+
+
+def iter_data_value_sets_xml(documents):
+    """
+    streaming counterpart of get_data_value_sets_xml, documents are values
+    dicts or rendered documents
+    """
+    yield (u"<?xml version='1.0' encoding='UTF-8'?>\n"
+           u'<dataValueSets xmlns="http://dhis2.org/schema/dxf/2.0">\n')
+    for document in documents:
+        if isinstance(document, basestring):
+            if document.startswith(u'<?xml'):
+                document = document.split(u'\n', 1)[-1]
+            yield document
+        else:
+            for piece in iter_data_value_set_xml(document, False):
+                yield piece
+        yield u'\n'
+    yield u'</dataValueSets>'
+
+
+def get_values_digest(values_list):
+    """
+    returns a digest of the values of data value sets, equal values give
+    equal payloads whatever the codec
+    """
+    digest = md5()
+    for values in values_list:
+        digest.update(json.dumps(values, sort_keys=True, default=force_text))
+    return digest.hexdigest()
+
+
+def get_data_value_set_json(values):
+    """
+    returns the DHIS2 JSON dataValueSet for a DataValueSetInterface values
+    dict, values are formatted as the XML template formats them
+    """
+    def text(value):
+        return force_text(localize(template_localtime(value)))
+
+    data_value_set = {'dataSet': values.get('dataSet'),
+                      'orgUnit': values.get('orgUnit'),
+                      'dataValues': []}
+    for key in ('period', 'completeDate'):
+        if key in values:
+            data_value_set[key] = values[key]
+    for element in values.get('dataElements', []):
+        data_value_set['dataValues'].append(
+            {'dataElement': element.get('id'),
+             'value': text(element.get('value'))})
+    return data_value_set
+
+
+class PayloadCodec(object):
+    """
+    Encodes data value sets for a dataValueSets request. Codecs set the
+    content_type of their documents and prerender, whether the sets must be
+    rendered from the template before encode() is given them.
+    """
+    content_type = None
+    stream = False
+
+    def __init__(self, stream=False):
+        self.stream = stream
+
+    def encode(self, entries):
+        """
+        returns the document for (xml, values) pairs, or an iterable of its
+        pieces
+        """
+        raise NotImplementedError
+
+    def get_body(self, entries, gzip=False):
+        """
+        returns the encoded entries, gzip compressed when gzip is set
+        """
+        body = self.encode(entries)
+        if gzip:
+            body = gzip_payload(body)
+        return body
+
+    def get_content_encoding(self, gzip=False):
+        return 'gzip' if gzip else None
+
+
+class XMLPayloadCodec(PayloadCodec):
+    """
+    dataValueSets XML, from the rendered template or streamed
+    """
+    content_type = "application/xml"
+
+    @property
+    def prerender(self):
+        return not self.stream
+
+    def encode(self, entries):
+        """
+        encodes (xml, values) pairs, xml is None for unrendered sets
+        """
+        documents = [values if xml is None else xml
+                     for xml, values in entries]
+        if self.stream or [d for d in documents
+                           if not isinstance(d, basestring)]:
+            return iter_data_value_sets_xml(documents)
+        return get_data_value_sets_xml(documents)
+
+
+class JSONPayloadCodec(PayloadCodec):
+    """
+    DHIS2 JSON, {"dataValueSets": [dataValueSet, ...]}
+    """
+    content_type = "application/json"
+    prerender = False
+
+    def iter_encode(self, entries):
+        yield u'{"dataValueSets": ['
+        for i, (xml, values) in enumerate(entries):
+            if i:
+                yield u', '
+            yield json.dumps(get_data_value_set_json(values))
+        yield u']}'
+
+    def encode(self, entries):
+        pieces = self.iter_encode(entries)
+        if self.stream:
+            return pieces
+        return u''.join(pieces)
+
+
+PAYLOAD_CODECS = {
+    'xml': XMLPayloadCodec,
+    'json': JSONPayloadCodec,
+}
+
+
+def get_payload_codec(url=None):
+    """
+    returns the payload codec configured for the DHIS2 instance at url
+    """
+    codec = PAYLOAD_CODECS[get_dhis2_target_option('CODEC', url)]
+    return codec(stream=settings.DHIS2_SERIALIZER == 'stream')
+
+
+def gzip_payload(payload):
+    """
+    gzip compresses a payload, an iterable payload is compressed piece by
+    piece as it is read
+    """
+    if isinstance(payload, basestring):
+        return ''.join(_iter_gzip([payload]))
+    return _iter_gzip(payload)
+
+
+def _iter_gzip(pieces):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for piece in pieces:
+        if isinstance(piece, unicode):
+            piece = piece.encode('utf-8')
+        data = compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class DataValueSetBatch(object):
+    """
+    Accumulates rendered data value sets and posts them to DHIS2 as one
+    dataValueSets document once settings.DHIS2_BATCH_MAX_SETS sets or
+    settings.DHIS2_BATCH_MAX_BYTES bytes have been collected.
+
+    Each set is added with an owner, usually its DataQueue item, and send()
+    maps the import summary DHIS2 returns back onto the owners.
+
+    Sets added without a rendered document are written out while the
+    request body streams, which is what the 'stream' DHIS2_SERIALIZER does.
+    The body is encoded by the DHIS2 target's payload codec and gzipped
+    when its DHIS2_GZIP option is set.
+
+    When metrics is set, the time each request took is observed as the
+    'send' stage of the services owning its sets.
+    """
+    max_sets = None
+    max_bytes = None
+    codec = None
+    gzip = False
+    metrics = None
+    entries = None
+    size = 0
+
+    def __init__(self, max_sets=None, max_bytes=None, codec=None,
+                 gzip=None):
+        self.max_sets = max_sets or settings.DHIS2_BATCH_MAX_SETS
+        self.max_bytes = max_bytes or settings.DHIS2_BATCH_MAX_BYTES
+        self.codec = codec or get_payload_codec()
+        if gzip is None:
+            gzip = get_dhis2_target_option('GZIP')
+        self.gzip = gzip
+        self.entries = []
+
+    def copy(self):
+        """
+        returns an empty batch with the same settings
+        """
+        batch = DataValueSetBatch(self.max_sets, self.max_bytes, self.codec,
+                                  self.gzip)
+        batch.metrics = self.metrics
+        return batch
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_size(self, xml, values):
+        if xml is None:
+            return estimate_data_value_set_size(values)
+        return len(xml)
+
+    def add(self, owner, xml, values):
+        self.entries.append((owner, xml, values))
+        self.size += self.get_size(xml, values)
+
+    def get_body(self):
+        """
+        returns the request body, a streamed body as a function returning
+        its pieces, see send_to_dhis2()
+        """
+        documents = [(x, v) for o, x, v in self.entries]
+        body = self.codec.get_body(documents, self.gzip)
+        if isinstance(body, basestring):
+            return body
+
+        def get_pieces():
+            return self.codec.get_body(documents, self.gzip)
+        return get_pieces
+
+    def is_full(self, next_size=0):
+        if not self.entries:
+            return False
+        return len(self.entries) >= self.max_sets or \
+            self.size + next_size > self.max_bytes
+
+    def get_ids(self, values):
+        ids = set([values.get('dataSet'), values.get('orgUnit'),
+                   values.get('period')])
+        for element in values.get('dataElements', []):
+            ids.add(element['id'])
+        return ids
+
+    def get_results(self, status, content):
+        """
+        returns (results, unresolved): (owner, success, message) tuples for
+        the sent entries and the entries DHIS2's response can't tell apart
+        from other entries of the batch, which send() posts again one by one
+        """
+        if status not in (200, 201, 202, 204):
+            message = u"DHIS2 responded with HTTP %s" % status
+            return [(owner, False, message)
+                    for owner, xml, values in self.entries], []
+        summaries = parse_import_summaries(content)
+        ids = [self.get_ids(values) for o, x, values in self.entries]
+        if len(summaries) == len(self.entries):
+            # one importSummary per dataValueSet, in the order posted
+            return [self.get_result(owner, summary['status'], [
+                (obj, value) for obj, value in summary['conflicts']
+                if obj in entry_ids])
+                for (owner, x, v), entry_ids, summary
+                in zip(self.entries, ids, summaries)], []
+        # one summary for the batch, a conflict belongs to the set it names
+        # only when no other set in the batch has that id
+        conflicts = [[] for entry in self.entries]
+        unresolved = set()
+        failed = False
+        for summary in summaries:
+            failed = failed or summary['status'] == 'ERROR'
+            for obj, value in summary['conflicts']:
+                matches = [i for i, entry_ids in enumerate(ids)
+                           if obj in entry_ids]
+                if len(matches) == 1:
+                    conflicts[matches[0]].append((obj, value))
+                else:
+                    unresolved.update(matches)
+        # an ERROR no conflict can be traced back to fails a single set
+        if failed and not unresolved and not any(conflicts):
+            if len(self.entries) == 1:
+                return [self.get_result(self.entries[0][0], 'ERROR',
+                                        [])], []
+            unresolved.update(range(len(ids)))
+        results = []
+        for i, (owner, xml, values) in enumerate(self.entries):
+            if conflicts[i] or i not in unresolved:
+                results.append(self.get_result(owner, None, conflicts[i]))
+        return results, [entry for i, entry in enumerate(self.entries)
+                         if i in unresolved and not conflicts[i]]
+
+    def get_result(self, owner, status, conflicts):
+        if conflicts:
+            return (owner, False, u"\n".join(
+                u"%s: %s" % conflict for conflict in conflicts))
+        if status == 'ERROR':
+            return (owner, False, u"DHIS2 import failed")
+        return (owner, True, None)
+
+    def send(self):
+        """
+        posts the accumulated sets and returns (owner, success, message)
+        tuples, success is None for sets not posted because the DHIS2
+        circuit breaker is open; sets a conflict can't be traced back to
+        are posted again one at a time; the batch is empty afterwards
+        """
+        if not self.entries:
+            return []
+        breaker = get_dhis2_circuit_breaker()
+        if not breaker.allow():
+            results = [(owner, None, u"DHIS2 is unavailable")
+                       for owner, x, v in self.entries]
+            self.entries = []
+            self.size = 0
+            return results
+        started = time.time()
+        try:
+            status, content = send_to_dhis2(
+                self.get_body(), self.codec.content_type,
+                self.codec.get_content_encoding(self.gzip))
+        except Exception, e:
+            self.observe_send(started)
+            breaker.record_failure()
+            results = [(owner, False, u"%s" % e)
+                       for owner, x, v in self.entries]
+        else:
+            self.observe_send(started)
+            if status == 429 or status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            results, unresolved = self.get_results(status, content)
+            for entry in unresolved:
+                batch = self.copy()
+                batch.add(*entry)
+                results.extend(batch.send())
+        self.entries = []
+        self.size = 0
+        return results
+
+    def observe_send(self, started):
+        if self.metrics is None:
+            return
+        service_ids = set([getattr(owner, 'service_id', None)
+                           for owner, x, v in self.entries])
+        service_ids.discard(None)
+        self.metrics.observe('send', time.time() - started, service_ids)
 
 
 def load_from_dhis2(url):
     """
         returns content loaded by given dhis2 url
+
+        Responses are kept in MetadataCache: one fetched less than
+        settings.DHIS2_METADATA_CACHE_TTL seconds ago is returned as is,
+        an older one is revalidated with If-None-Match/If-Modified-Since
+        so an unchanged resource costs a 304. At most
+        settings.DHIS2_METADATA_CACHE_MAX_SIZE bytes are kept, least
+        recently used entries are evicted first.
     """
-    auth = base64.encodestring(
-        settings.DHIS2_USERNAME + ':' + settings.DHIS2_PASSWORD)
-    headers = {'Authorization' : 'Basic ' + auth}
-    http = httplib2.Http()
-    http.add_credentials(settings.DHIS2_USERNAME, settings.DHIS2_PASSWORD)
-    resp, content = http.request(url, headers=headers)
+    now = datetime.now()
+    url_hash = MetadataCache.get_url_hash(url)
+    try:
+        entry = MetadataCache.objects.get(url_hash=url_hash)
+    except MetadataCache.DoesNotExist:
+        entry = None
+    if entry is not None and entry.fetched_on + timedelta(
+            seconds=settings.DHIS2_METADATA_CACHE_TTL) > now:
+        MetadataCache.objects.filter(pk=entry.pk).update(used_on=now)
+        return 200, entry.content
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+    resp, content = get_dhis2_client().request(url, headers=headers)
+    if resp.status == 304 and entry is not None:
+        MetadataCache.objects.filter(pk=entry.pk).update(
+            fetched_on=now, used_on=now)
+        return 200, entry.content
+    if resp.status == 200:
+        cache_metadata(entry, url, url_hash, resp, content, now)
     return resp.status, content
 
 
+def cache_metadata(entry, url, url_hash, resp, content, now):
+    size = len(content)
+    if size > settings.DHIS2_METADATA_CACHE_MAX_SIZE:
+        if entry is not None:
+            entry.delete()
+        return
+    if entry is None:
+        entry = MetadataCache(url_hash=url_hash, url=url)
+    entry.etag = resp.get('etag')
+    entry.last_modified = resp.get('last-modified')
+    entry.content = content
+    entry.size = size
+    entry.fetched_on = entry.used_on = now
+    try:
+        with transaction.commit_on_success():
+            entry.save()
+    except IntegrityError:
+        # cached by a concurrent request meanwhile
+        return
+    MetadataCache.evict(settings.DHIS2_METADATA_CACHE_MAX_SIZE)
+
+
+def get_org_unit_pks(org_unit_ids):
+    """
+    returns {org_unit_id: pk} of the existing organisation units among
+    org_unit_ids, looked up settings.BULK_LOOKUP_CHUNK_SIZE ids per query
+    """
+    pks = {}
+    size = settings.BULK_LOOKUP_CHUNK_SIZE
+    for i in range(0, len(org_unit_ids), size):
+        pks.update(OrganizationUnit.objects.filter(
+            org_unit_id__in=org_unit_ids[i:i + size])
+            .values_list('org_unit_id', 'pk'))
+    return pks
+
+
+def parse_dhis2_date(value):
+    """
+    returns the naive UTC datetime of a DHIS2 timestamp such as
+    2013-05-02T10:11:12.345+0200, ignoring fractions; one without an offset
+    is taken to be in UTC
+    """
+    try:
+        date = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    match = re.search(r'([+-])(\d\d):?(\d\d)$', value[19:])
+    if match:
+        offset = timedelta(hours=int(match.group(2)),
+                           minutes=int(match.group(3)))
+        if match.group(1) == '+':
+            date -= offset
+        else:
+            date += offset
+    return date
+
+
+def get_dhis2_changes(api_url, resource, since):
+    """
+    returns the [{'id': ..., 'name': ...}, ...] of a DHIS2 collection, e.g.
+    organisationUnits, changed since the given UTC datetime or None if they
+    could not be loaded
+    """
+    url = u'%s/%s.json?%s' % (api_url, resource, urllib.urlencode({
+        'lastUpdated': since.strftime('%Y-%m-%dT%H:%M:%S+0000'),
+        'paging': 'false'}))
+    resp, content = get_dhis2_client().request(
+        url, headers={'Accept': 'application/json'})
+    if resp.status != 200:
+        return None
+    try:
+        return json.loads(content).get(resource, [])
+    except ValueError:
+        return None
+
+
+def rename_rows(queryset, field, current, names):
+    """
+    renames the queryset's rows, identified by field, whose name in current,
+    {key: name}, differs from the one in names, returns the number renamed
+
+    Each chunk of rows is renamed by a single UPDATE, a row takes three
+    parameters so a chunk has a third of settings.BULK_LOOKUP_CHUNK_SIZE.
+    """
+    renamed = dict([(key, name) for key, name in names.items()
+                    if key in current and current[key] != name])
+    keys = renamed.keys()
+    size = max(1, settings.BULK_LOOKUP_CHUNK_SIZE / 3)
+    opts = queryset.model._meta
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for i in range(0, len(keys), size):
+        rows = list(queryset.filter(**{field + '__in': keys[i:i + size]})
+                    .values_list('pk', field))
+        if not rows:
+            continue
+        params = []
+        for pk, key in rows:
+            params.extend([pk, renamed[key]])
+        params.extend([pk for pk, key in rows])
+        cursor.execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+            qn(opts.db_table), qn(opts.get_field('name').column),
+            qn(opts.pk.column), ' '.join(['WHEN %s THEN %s'] * len(rows)),
+            qn(opts.pk.column), ', '.join(['%s'] * len(rows))), params)
+    if keys:
+        transaction.commit_unless_managed()
+    return len(renamed)
+
+
+@transaction.commit_on_success
+def sync_data_set(ds, now=None):
+    """
+    Brings a DataSet, its data elements and organisation units up to date
+    with DHIS2, looking only at metadata changed since ds.last_synced_on.
+
+    The data set document is reloaded, conditionally, and its members only
+    compared when DHIS2 reports it changed; data elements and organisation
+    units renamed since the last sync are fetched with lastUpdated filters.
+    Changes are applied in bulk and ds.last_synced_on advanced to when the
+    sync started. Both it and DHIS2's timestamps are compared in UTC, the
+    server's TIME_ZONE need not match DHIS2's.
+
+    returns a summary of the changes, or None if DHIS2 could not be reached
+    in which case nothing changes
+    """
+    now = now or datetime.utcnow()
+    since = ds.last_synced_on
+    status, content = load_from_dhis2(ds.url + '.json')
+    if status != 200:
+        return None
+    data = json.loads(content)
+    elements = org_units = []
+    if since is not None:
+        api_url = ds.url.rsplit('/dataSets/', 1)[0]
+        elements = get_dhis2_changes(api_url, 'dataElements', since)
+        org_units = get_dhis2_changes(api_url, 'organisationUnits', since)
+        if elements is None or org_units is None:
+            return None
+    summary = {'elements_added': 0, 'elements_renamed': 0,
+               'elements_removed': 0, 'org_units_added': 0,
+               'org_units_renamed': 0, 'org_units_removed': 0,
+               'changed': False}
+    updated = parse_dhis2_date(data.get('lastUpdated'))
+    if since is None or updated is None or updated >= since:
+        summary['changed'] = True
+        ds.name = data['name']
+        ds.frequency = DataSet.get_frequency(data['periodType'])
+        sync_data_set_members(ds, data, summary)
+    summary['elements_renamed'] += rename_rows(
+        ds.dataelement_set.all(), 'data_element_id',
+        dict(ds.dataelement_set.values_list('data_element_id', 'name')),
+        dict([(de['id'], de['name']) for de in elements]))
+    summary['org_units_renamed'] += rename_rows(
+        OrganizationUnit.objects.all(), 'org_unit_id',
+        dict(ds.organizations.values_list('org_unit_id', 'name')),
+        dict([(ou['id'], ou['name']) for ou in org_units]))
+    ds.last_synced_on = now
+    ds.save()
+    return summary
+
+
+def sync_data_set_members(ds, data, summary):
+    """
+    adds and removes the data elements and organisation units of ds to
+    match a DHIS2 data set document
+    """
+    size = settings.BULK_LOOKUP_CHUNK_SIZE
+    current = dict(ds.dataelement_set.values_list('data_element_id', 'name'))
+    names = dict([(de['id'], de['name']) for de in data['dataElements']])
+    added = [key for key in names if key not in current]
+    removed = [key for key in current if key not in names]
+    DataElement.objects.bulk_create([
+        DataElement(data_element_id=key, name=names[key], data_set=ds)
+        for key in added])
+    for i in range(0, len(removed), size):
+        DataElement.objects.filter(
+            data_set=ds, data_element_id__in=removed[i:i + size]).delete()
+    summary['elements_added'] = len(added)
+    summary['elements_removed'] = len(removed)
+    summary['elements_renamed'] = rename_rows(
+        ds.dataelement_set.all(), 'data_element_id', current, names)
+
+    current = dict(ds.organizations.values_list('org_unit_id', 'name'))
+    members = dict(ds.organizations.values_list('org_unit_id', 'pk'))
+    names = dict([(ou['id'], ou['name']) for ou in data['organisationUnits']])
+    added = [key for key in names if key not in members]
+    removed = [members[key] for key in members if key not in names]
+    org_units = get_org_unit_pks(added)
+    OrganizationUnit.objects.bulk_create([
+        OrganizationUnit(org_unit_id=key, name=names[key])
+        for key in added if key not in org_units])
+    # pks of bulk created rows are not returned on every backend
+    org_units.update(get_org_unit_pks(
+        [key for key in added if key not in org_units]))
+    through = DataSet.organizations.through
+    through.objects.bulk_create([
+        through(dataset_id=ds.pk, organizationunit_id=org_units[key])
+        for key in added])
+    for i in range(0, len(removed), size):
+        through.objects.filter(
+            dataset=ds, organizationunit__in=removed[i:i + size]).delete()
+    summary['org_units_added'] = len(added)
+    summary['org_units_removed'] = len(removed)
+    summary['org_units_renamed'] = rename_rows(
+        OrganizationUnit.objects.all(), 'org_unit_id', current, names)
+
+
+def sync_dhis2_metadata(data_sets=None):
+    """
+    syncs every imported DataSet, or the given ones, returns
+    {data_set_id: summary}
+    """
+    if data_sets is None:
+        data_sets = DataSet.objects.filter(url__isnull=False)
+    return dict([(ds.data_set_id, sync_data_set(ds)) for ds in data_sets])
+
+
 def test_f2dhis():
     dvs = DataValueSet.objects.all()[0]
     try:
-        data = get_data_from_formub(dvs, 3)
+        data = get_data_from_formub(dvs.service, 3)
     except Exception, e:
         print e
     else:
@@ -147,40 +1014,918 @@ def test_f2dhis():
             send_to_dhis2(xml)
 
 
-def process_data_queue():
+def get_lease_id():
+    """
+    returns an identifier for the leases of one queue run
+    """
+    return (u"%s:%s:%s" % (socket.gethostname()[:32], os.getpid(),
+                           uuid4().hex[:16]))
+
+
+def release_expired_leases():
+    """
+    releases leases of queue items whose worker did not finish them in time,
+    returns the number of released items
+    """
+    return DataQueue.objects.filter(lease_expires__lt=datetime.now())\
+        .update(leased_by=None, lease_expires=None)
+
+
+def get_retry_delay(attempts):
+    """
+    returns how long to wait before attempt number attempts + 1, doubling
+    from settings.DATA_QUEUE_RETRY_DELAY up to DATA_QUEUE_MAX_RETRY_DELAY
+    with jitter so failed items do not come back all at once
+    """
+    delay = min(settings.DATA_QUEUE_MAX_RETRY_DELAY,
+                settings.DATA_QUEUE_RETRY_DELAY * 2 ** (attempts - 1))
+    return timedelta(seconds=random.uniform(delay / 2.0, delay))
+
+
+class BatchSender(threading.Thread):
+    """
+    Posts the batches handed to it one after the other on its own thread and
+    puts their results on a shared queue.
+    """
+    batches = None
+    results = None
+
+    def __init__(self, results):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        # keep at most a couple of rendered batches waiting per sender
+        self.batches = Queue.Queue(maxsize=2)
+        self.results = results
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            self.results.put(batch.send())
+
+
+class DataQueueProcessor(object):
     """
-    Process all queued data
-    returns number of processed records
+    Sends queued Formhub submissions to DHIS2.
+
+    Pending items are grouped by service and their submissions pulled from
+    Formhub in chunks of settings.FORMHUB_FETCH_CHUNK_SIZE, one query per
+    chunk. A submission is fetched once per run and rendered against every
+    DataValueSet mapped to its service; the rendered sets are posted in
+    DataValueSetBatch batches and an item is marked processed once all its
+    sets have been accepted.
+
+    With a concurrency above 1 up to that many chunks are fetched ahead on a
+    thread pool while earlier ones are rendered, and sets are spread over as
+    many sender threads by (orgUnit, period, dataSet), so sets for the same
+    key are still posted in queue order. Database access stays on the
+    calling thread.
+
+    Items are leased to the run settings.DATA_QUEUE_CLAIM_SIZE at a time, see
+    claim_items(), so any number of workers can drain the queue together
+    without sending an item twice.
+
+    Submissions Formhub pushed to the webhook are kept with their item and
+    not fetched at all. An item queued again while it is being sent is left
+    pending, see save_item().
+
+    Items that cannot be sent are retried with backoff, see retry_item(),
+    and only items that are due are claimed. The run stops early while the
+    DHIS2 circuit breaker is open, items with sets it refused are put off
+    without counting an attempt, see postpone_item().
+
+    The digest of each set DHIS2 accepted is kept in SentPayload, so a
+    re-posted submission only sends the sets that changed.
+
+    The time spent fetching, loading, rendering and sending is kept in
+    metrics and added to the summary as histograms per stage and per
+    service, see main.metrics.
     """
-    processed = 0
-    for dq in DataQueue.objects.filter(processed=False):
-        success = False
-        for dvs in DataValueSet.objects.filter(service=dq.service):
+    # only process items of this FormhubService when set
+    service_id = None
+    chunk_size = None
+    claim_size = None
+    # identifies the leases taken by this run
+    lease_id = None
+    # highest pk claimed so far, items are claimed in pk order
+    last_claimed = 0
+    concurrency = 1
+    batches = None
+    senders = None
+    results = None
+    pool = None
+    submissions = None
+    data_value_sets = None
+    summary = None
+    # Formhub requests fetching per DataValueSet would have made
+    fetch_demand = 0
+    # DataQueue pk => number of its sets still waiting in a batch
+    outstanding = None
+    # DataQueue pk => messages of its rejected sets
+    failures = None
+    # pks of the DataQueue items with sets the circuit breaker refused
+    refused = None
+    # (DataQueue pk, DataValueSet pk) => digest of the set last accepted
+    sent_digests = None
+    # DataQueue pk => {DataValueSet pk: digest} of the sets being sent
+    digests = None
+    metrics = None
+    # seconds the DHIS2 throttle had made requests wait when the run started
+    queue_wait = 0.0
+
+    def __init__(self, chunk_size=None, batch=None, concurrency=None,
+                 claim_size=None, service_id=None):
+        self.service_id = service_id
+        self.chunk_size = chunk_size or settings.FORMHUB_FETCH_CHUNK_SIZE
+        self.claim_size = claim_size or settings.DATA_QUEUE_CLAIM_SIZE
+        self.lease_id = get_lease_id()
+        self.concurrency = max(
+            1, concurrency or settings.DATA_QUEUE_CONCURRENCY)
+        self.metrics = StageMetrics()
+        if batch is None:
+            batch = DataValueSetBatch()
+        batch.metrics = self.metrics
+        self.batches = [batch] + [
+            batch.copy() for i in range(1, self.concurrency)]
+        self.submissions = {}
+        self.data_value_sets = {}
+        self.outstanding = {}
+        self.failures = {}
+        self.refused = set()
+        self.sent_digests = {}
+        self.digests = {}
+        self.summary = {'processed': 0, 'missing': 0, 'failed': 0,
+                        'fetch_failed': 0, 'dead': 0, 'postponed': 0,
+                        'superseded': 0, 'fetches': 0, 'pushed': 0,
+                        'saved_fetches': 0, 'batches': 0,
+                        'unchanged': 0, 'skipped_sets': 0,
+                        'circuit_open': False, 'dhis2_limit': None,
+                        'dhis2_queue_wait': 0.0, 'stages': {},
+                        'services': {}}
+
+    def get_data_value_sets(self, service):
+        if service.pk not in self.data_value_sets:
+            self.data_value_sets[service.pk] = list(
+                DataValueSet.objects.filter(service=service))
+        return self.data_value_sets[service.pk]
+
+    def request_submissions(self, service, uuids):
+        """
+        safe to call from a worker thread, returns None on failure
+        """
+        started = time.time()
+        try:
+            return get_submissions_from_formhub(service, uuids)
+        except Exception:
+            return None
+        finally:
+            self.metrics.observe('fetch', time.time() - started,
+                                 [service.pk])
+
+    def store_submissions(self, service, uuids, records):
+        """
+        caches fetched records, the ones Formhub did not return are cached
+        as an empty list
+        """
+        if isinstance(records, AsyncResult):
+            records = records.get()
+        self.summary['fetches'] += 1
+        for uuid in uuids:
+            if records is None:
+                data = None
+            else:
+                data = records.get(uuid, [])
+            self.submissions[(service.pk, uuid)] = data
+
+    def get_uncached(self, service, items):
+        return [dq.data_id for dq in items if not dq.payload and
+                (service.pk, dq.data_id) not in self.submissions]
+
+    def request_chunk(self, service, chunk):
+        """
+        starts fetching the submissions of a chunk of queued items with one
+        query, on the thread pool when running concurrently
+        """
+        uuids = self.get_uncached(service, chunk)
+        result = None
+        if uuids and self.pool is not None:
+            result = self.pool.apply_async(self.request_submissions,
+                                           (service, uuids))
+        return service, uuids, result
+
+    def complete_chunk(self, service, uuids, result):
+        if not uuids:
+            return
+        if result is None:
+            result = self.request_submissions(service, uuids)
+        self.store_submissions(service, uuids, result)
+
+    def iter_items(self, items):
+        """
+        yields claimed items in pk order once their submissions are cached,
+        fetching up to concurrency chunks ahead while earlier items are
+        rendered
+        """
+        chunks = []
+        for service, group in groupby(items, lambda dq: dq.service):
+            group = list(group)
+            for i in range(0, len(group), self.chunk_size):
+                chunks.append((service, group[i:i + self.chunk_size]))
+        # chunks in the order their first items come up, the chunk of an
+        # item is then always the first one not stored yet
+        chunks.sort(key=lambda chunk: chunk[1][0].pk)
+        chunk_of = {}
+        for i, (service, chunk) in enumerate(chunks):
+            for dq in chunk:
+                chunk_of[dq.pk] = i
+        ahead = self.concurrency if self.pool is not None else 1
+        requested = deque()
+        next_chunk = stored = 0
+        for dq in sorted(items, key=lambda dq: dq.pk):
+            while next_chunk < len(chunks) and len(requested) < ahead:
+                requested.append(self.request_chunk(*chunks[next_chunk]))
+                next_chunk += 1
+            while stored <= chunk_of[dq.pk]:
+                self.complete_chunk(*requested.popleft())
+                stored += 1
+            yield dq
+
+    def get_submission(self, dq):
+        """
+        returns the Formhub records for a queued item, fetching them at
+        most once per run unless Formhub pushed the submission
+        """
+        if dq.payload:
+            self.summary['pushed'] += 1
+            return [json.loads(dq.payload)]
+        key = (dq.service_id, dq.data_id)
+        if key not in self.submissions:
+            started = time.time()
             try:
-                data = get_data_from_formub(dvs, dq.data_id)
+                data = get_data_from_formub(dq.service, dq.data_id)
             except Exception:
-                pass
-            else:
-                if data is not None and isinstance(data, list):
-                    for record in data:
-                        xml = get_data_value_set_xml(dvs, record)
-                        status, response = send_to_dhis2(xml)
-                        success = True
-                        print xml, response
-        if success:
-            dq.processed = True
-            dq.processed_on = datetime.now()
-            dq.save()
-            processed += 1
-    return processed
+                data = None
+            self.metrics.observe('fetch', time.time() - started,
+                                 [dq.service_id])
+            self.submissions[key] = data
+            self.summary['fetches'] += 1
+        return self.submissions[key]
+
+    def process_item(self, dq):
+        dvs_list = self.get_data_value_sets(dq.service)
+        if not dvs_list:
+            return
+        self.fetch_demand += len(dvs_list)
+        data = self.get_submission(dq)
+        if data is None or not isinstance(data, list):
+            self.summary['fetch_failed'] += 1
+            self.retry_item(dq, DataQueue.STATUS_FAILED,
+                            u"Failed to fetch the submission from Formhub")
+            return
+        if not len(data):
+            self.summary['missing'] += 1
+            self.retry_item(dq, DataQueue.STATUS_MISSING,
+                            u"Submission not found on Formhub")
+            return
+        # hold the item open until all its sets are in a batch
+        self.retain(dq)
+        prerender = self.batches[0].codec.prerender
+        changed = False
+        for dvs in dvs_list:
+            sets = []
+            started = time.time()
+            for record in data:
+                sets.append(DataValueSetInterface(dvs, record))
+                sets[-1].values = sets[-1].load_dict()
+            self.metrics.observe('load_dict', time.time() - started,
+                                 [dq.service_id])
+            digest = get_values_digest([dvsi.values for dvsi in sets])
+            if self.sent_digests.get((dq.pk, dvs.pk)) == digest:
+                self.summary['skipped_sets'] += len(sets)
+                continue
+            changed = True
+            self.digests.setdefault(dq.pk, {})[dvs.pk] = digest
+            for dvsi in sets:
+                xml = None
+                if prerender:
+                    started = time.time()
+                    xml = dvsi.render(dvsi.values)
+                    self.metrics.observe('render', time.time() - started,
+                                         [dq.service_id])
+                self.add_to_batch(dq, xml, dvsi.values)
+        if not changed:
+            self.summary['unchanged'] += 1
+        self.release(dq)
+
+    def get_lane(self, values):
+        """
+        returns the index of the batch a set goes to, sets with the same
+        orgUnit, period and dataSet always share one
+        """
+        if self.concurrency == 1:
+            return 0
+        key = (values.get('orgUnit'), values.get('period'),
+               values.get('dataSet'))
+        return hash(key) % self.concurrency
+
+    def add_to_batch(self, dq, xml, values):
+        lane = self.get_lane(values)
+        batch = self.batches[lane]
+        if batch.is_full(batch.get_size(xml, values)):
+            self.flush(lane)
+        self.retain(dq)
+        self.batches[lane].add(dq, xml, values)
+        if self.batches[lane].is_full():
+            self.flush(lane)
+
+    def flush(self, lane=0):
+        batch = self.batches[lane]
+        if not len(batch):
+            return
+        self.summary['batches'] += 1
+        if self.senders is None:
+            self.apply_results(batch.send())
+            return
+        self.batches[lane] = batch.copy()
+        self.senders[lane].batches.put(batch)
+        self.collect_results()
+
+    def collect_results(self, block=False):
+        while True:
+            try:
+                results = self.results.get(block)
+            except Queue.Empty:
+                return
+            self.apply_results(results)
+            if block:
+                return
+
+    def apply_results(self, results):
+        for dq, success, message in results:
+            if success is None:
+                self.refused.add(dq.pk)
+            elif not success:
+                self.failures.setdefault(dq.pk, []).append(message)
+            self.release(dq)
+
+    def retain(self, dq):
+        self.outstanding[dq.pk] = self.outstanding.get(dq.pk, 0) + 1
+
+    def release(self, dq):
+        self.outstanding[dq.pk] -= 1
+        if not self.outstanding[dq.pk]:
+            del self.outstanding[dq.pk]
+            failures = self.failures.pop(dq.pk, None)
+            if dq.pk in self.refused:
+                self.refused.remove(dq.pk)
+                if not failures:
+                    self.postpone_item(dq)
+                    return
+            self.finish_item(dq, failures)
+
+    def load_sent_digests(self, items):
+        """
+        caches the digests of the sets last accepted for claimed items
+        """
+        rows = SentPayload.objects\
+            .filter(data_queue__in=[dq.pk for dq in items])\
+            .values_list('data_queue', 'data_value_set', 'digest')
+        for dq_pk, dvs_pk, digest in rows:
+            self.sent_digests[(dq_pk, dvs_pk)] = digest
+
+    def save_digests(self, dq):
+        """
+        records the digests of an item's sets once DHIS2 accepted them all
+        """
+        digests = self.digests.pop(dq.pk, {})
+        if not digests:
+            return
+        replaced = [dvs_pk for dvs_pk in digests
+                    if (dq.pk, dvs_pk) in self.sent_digests]
+        if replaced:
+            SentPayload.objects.filter(data_queue=dq.pk,
+                                       data_value_set__in=replaced).delete()
+        now = datetime.now()
+        SentPayload.objects.bulk_create([
+            SentPayload(data_queue_id=dq.pk, data_value_set_id=dvs_pk,
+                        digest=digest, sent_on=now)
+            for dvs_pk, digest in digests.items()])
+        for dvs_pk, digest in digests.items():
+            self.sent_digests[(dq.pk, dvs_pk)] = digest
+
+    def save_item(self, dq, **fields):
+        """
+        writes the outcome of an item and gives up its lease, unless the row
+        changed since it was claimed, e.g. a webhook queued the submission
+        again, which is then left pending for another run; returns True if
+        the outcome was written
+        """
+        now = datetime.now()
+        fields.update(leased_by=None, lease_expires=None, modified_on=now)
+        saved = DataQueue.objects.filter(
+            pk=dq.pk, leased_by=self.lease_id,
+            modified_on=dq.modified_on).update(**fields)
+        if not saved:
+            self.summary['superseded'] += 1
+        return bool(saved)
+
+    def finish_item(self, dq, failures=None):
+        if failures:
+            self.digests.pop(dq.pk, None)
+            self.summary['failed'] += 1
+            self.retry_item(dq, DataQueue.STATUS_FAILED, u"\n".join(failures))
+            return
+        self.save_digests(dq)
+        # sent, the pushed submission is not needed any more
+        if self.save_item(dq, processed=True, processed_on=datetime.now(),
+                          status=DataQueue.STATUS_PROCESSED, message=None,
+                          payload=None, attempts=0, next_attempt_on=None):
+            self.summary['processed'] += 1
+
+    def get_postponed_until(self):
+        return datetime.now() + timedelta(
+            seconds=get_dhis2_circuit_breaker().reset_timeout)
+
+    def postpone_item(self, dq):
+        """
+        puts an item off until the DHIS2 circuit breaker lets requests
+        through again, it was not sent so no attempt is counted
+        """
+        self.digests.pop(dq.pk, None)
+        if self.save_item(dq, message=u"DHIS2 is unavailable",
+                          next_attempt_on=self.get_postponed_until()):
+            self.summary['postponed'] += 1
+
+    def retry_item(self, dq, status, message):
+        """
+        schedules another attempt for an item, an item that used up
+        settings.DATA_QUEUE_MAX_ATTEMPTS attempts becomes a dead letter
+        """
+        attempts = dq.attempts + 1
+        if attempts >= settings.DATA_QUEUE_MAX_ATTEMPTS:
+            if self.save_item(dq, attempts=attempts, message=message,
+                              status=DataQueue.STATUS_DEAD,
+                              next_attempt_on=None):
+                self.summary['dead'] += 1
+            return
+        self.save_item(dq, attempts=attempts, message=message, status=status,
+                       next_attempt_on=datetime.now() +
+                       get_retry_delay(attempts))
+
+    def get_queue(self):
+        """
+        returns the pending items that are due and the run has not looked
+        at yet
+        """
+        queue = DataQueue.objects.filter(processed=False,
+                                         pk__gt=self.last_claimed)\
+            .exclude(status=DataQueue.STATUS_DEAD)\
+            .filter(Q(next_attempt_on__isnull=True) |
+                    Q(next_attempt_on__lte=datetime.now()))
+        if self.service_id is not None:
+            queue = queue.filter(service=self.service_id)
+        return queue
+
+    def claim_items(self):
+        """
+        leases the next settings.DATA_QUEUE_CLAIM_SIZE pending items that
+        are not leased to another worker and returns them sorted by
+        service, leases already held by the run are renewed
+        """
+        now = datetime.now()
+        expires = now + timedelta(seconds=settings.DATA_QUEUE_LEASE_TIMEOUT)
+        with transaction.commit_on_success():
+            DataQueue.objects.filter(leased_by=self.lease_id)\
+                .update(lease_expires=expires)
+            candidates = self.get_queue()\
+                .filter(Q(lease_expires__isnull=True) |
+                        Q(lease_expires__lt=now))\
+                .order_by('pk')
+            if connection.features.has_select_for_update:
+                candidates = candidates.select_for_update()
+            pks = list(candidates.values_list('pk', flat=True)
+                       [:self.claim_size])
+            if not pks:
+                return []
+            self.last_claimed = pks[-1]
+            # only rows nobody leased or finished in the meantime are taken
+            DataQueue.objects.filter(pk__in=pks, processed=False)\
+                .filter(Q(lease_expires__isnull=True) |
+                        Q(lease_expires__lt=now))\
+                .update(leased_by=self.lease_id, lease_expires=expires)
+        items = DataQueue.objects\
+            .filter(pk__in=pks, leased_by=self.lease_id)\
+            .select_related('service').order_by('service', 'pk')
+        return list(items)
+
+    def release_items(self):
+        """
+        gives up the leases on items the run did not finish
+        """
+        DataQueue.objects.filter(leased_by=self.lease_id)\
+            .update(leased_by=None, lease_expires=None)
+
+    def start(self):
+        self.queue_wait = get_dhis2_throttle().get_stats()['queue_wait_time']
+        if self.concurrency == 1:
+            return
+        self.pool = ThreadPool(self.concurrency)
+        self.results = Queue.Queue()
+        self.senders = [BatchSender(self.results)
+                        for i in range(self.concurrency)]
+        for sender in self.senders:
+            sender.start()
+
+    def stop(self):
+        if self.senders is not None:
+            for sender in self.senders:
+                sender.batches.put(None)
+            for sender in self.senders:
+                sender.join()
+            self.collect_results()
+            self.senders = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def record_stats(self):
+        """
+        adds the DHIS2 throttle's stats and the stage timings to the summary
+        and publishes them for the metrics view
+        """
+        stats = get_dhis2_throttle().get_stats()
+        self.summary['dhis2_limit'] = stats['limit']
+        self.summary['dhis2_queue_wait'] = \
+            stats['queue_wait_time'] - self.queue_wait
+        self.summary.update(self.metrics.to_dict())
+        publish_run_metrics(self.summary)
+
+    def run(self):
+        self.start()
+        try:
+            breaker = get_dhis2_circuit_breaker()
+            while True:
+                if breaker.is_open():
+                    self.summary['circuit_open'] = True
+                    break
+                last_claimed = self.last_claimed
+                items = self.claim_items()
+                if self.last_claimed == last_claimed:
+                    break
+                items = [dq for dq in items
+                         if self.get_data_value_sets(dq.service)]
+                self.load_sent_digests(items)
+                for dq in self.iter_items(items):
+                    # the rest of the claim is released unsent
+                    if breaker.is_open():
+                        break
+                    self.process_item(dq)
+            for lane in range(self.concurrency):
+                self.flush(lane)
+        finally:
+            self.stop()
+            self.release_items()
+        self.summary['saved_fetches'] = max(
+            0, self.fetch_demand - self.summary['fetches'])
+        self.record_stats()
+        return self.summary
+
+
+HTTP_POOL_OUTCOMES = ('hits', 'misses', 'expired', 'discarded')
+
+# HTTP pool stats of this process already added to the shared counters
+published_pool_stats = {}
+published_pool_stats_lock = threading.Lock()
+
+
+def publish_run_metrics(summary):
+    """
+    adds what the HTTP pool of this process counted since it last did and
+    the seconds a queue run waited for the DHIS2 throttle to the counters of
+    the metrics view, and reports the DHIS2 concurrency limit and circuit
+    breaker state the run ended with
+
+    Runs, and so the requests to DHIS2, happen in the Celery workers while
+    the metrics view is served by the web processes, so these go through
+    the cache like the DHIS2 response counts.
+    """
+    stats = get_http_pool().get_stats()
+    with published_pool_stats_lock:
+        deltas = [(outcome,
+                   stats[outcome] - published_pool_stats.get(outcome, 0))
+                  for outcome in HTTP_POOL_OUTCOMES]
+        published_pool_stats.update(
+            [(outcome, stats[outcome]) for outcome in HTTP_POOL_OUTCOMES])
+    for outcome, delta in deltas:
+        incr_counter('http_pool', outcome, delta)
+    incr_counter('dhis2_queue_wait', 'ms',
+                 int(round(summary['dhis2_queue_wait'] * 1000)))
+    set_gauge('dhis2_concurrency_limit', summary['dhis2_limit'])
+    set_gauge('dhis2_circuit_open', summary['circuit_open'] or
+              get_dhis2_circuit_breaker().is_open())
+
+
+QUEUE_STATUS_LABELS = {
+    DataQueue.STATUS_PENDING: 'pending',
+    DataQueue.STATUS_MISSING: 'missing',
+    DataQueue.STATUS_FAILED: 'failed',
+    DataQueue.STATUS_DEAD: 'dead',
+}
+
+
+def get_metrics(now=None):
+    """
+    returns the metrics view's text: the unprocessed DataQueue items per
+    service and status, the age of the oldest item still to be sent, the
+    items processed in the last minute and the DHIS2 response counts, along
+    with the HTTP pool, DHIS2 throttle and circuit breaker figures queue runs
+    published, see publish_run_metrics()
+
+    The queue is read with aggregate queries on DataQueue's indexes, so it
+    is cheap to scrape however many items were processed.
+    """
+    if now is None:
+        now = datetime.now()
+    unprocessed = DataQueue.objects.filter(processed=False)
+    counts = dict([
+        ((service_id, status), count) for service_id, status, count
+        in unprocessed.values_list('service', 'status')
+        .annotate(count=Count('pk')).order_by()])
+    queue = []
+    for service in FormhubService.objects.order_by('pk'):
+        for status in sorted(QUEUE_STATUS_LABELS):
+            queue.append(([('service', service.id_string),
+                           ('service_id', service.pk),
+                           ('status', QUEUE_STATUS_LABELS[status])],
+                          counts.get((service.pk, status), 0)))
+    oldest = unprocessed.exclude(status=DataQueue.STATUS_DEAD)\
+        .order_by('created_on').values_list('created_on', flat=True)[:1]
+    age = 0.0
+    if oldest:
+        age = max(0.0, (now - oldest[0]).total_seconds())
+    processed = DataQueue.objects.filter(
+        processed_on__gte=now - timedelta(minutes=1)).count()
+    queue_wait = dict(get_counters('dhis2_queue_wait', ['ms']))['ms']
+    return format_metrics([
+        ('f2dhis2_queue_items', 'gauge',
+         'Unprocessed queue items per service and status.', queue),
+        ('f2dhis2_queue_oldest_item_age_seconds', 'gauge',
+         'Age of the oldest unprocessed item that is not a dead letter.',
+         [([], age)]),
+        ('f2dhis2_queue_processed_last_minute', 'gauge',
+         'Queue items sent to DHIS2 in the last minute.',
+         [([], processed)]),
+        ('f2dhis2_dhis2_responses_total', 'counter',
+         'DHIS2 data value set responses by status, error when there was '
+         'no response.',
+         [([('status', label)], count)
+          for label, count in get_dhis2_response_counts()]),
+        ('f2dhis2_dhis2_queue_wait_seconds_total', 'counter',
+         'Seconds queue runs waited for the DHIS2 rate and concurrency '
+         'limits.',
+         [([], queue_wait / 1000.0)]),
+        ('f2dhis2_http_pool_connections_total', 'counter',
+         'Connections queue runs took from or returned to their HTTP pool, '
+         'by outcome.',
+         [([('outcome', label)], count) for label, count
+          in get_counters('http_pool', HTTP_POOL_OUTCOMES)]),
+        ('f2dhis2_dhis2_concurrency_limit', 'gauge',
+         'DHIS2 requests in flight at once the last queue run ended with.',
+         [([], get_gauge('dhis2_concurrency_limit'))]),
+        ('f2dhis2_dhis2_circuit_open', 'gauge',
+         'Whether the last queue run ended with sending to DHIS2 stopped.',
+         [([], get_gauge('dhis2_circuit_open'))]),
+    ])
+
+
+def process_data_queue(concurrency=None, service_id=None):
+    """
+    Process all queued data, or that of one FormhubService
+    returns a summary of the run, the number of processed records is in
+    summary['processed']
+    """
+    return DataQueueProcessor(concurrency=concurrency,
+                              service_id=service_id).run()
+
+
+class BackfillRecord(object):
+    """
+    A Formhub record being backfilled, stands in for the DataQueue item
+    that DataQueueProcessor tracks its sets by
+    """
+    def __init__(self, pk, data, service_id=None):
+        self.pk = pk
+        self.data = data
+        self.data_id = data.get('_uuid')
+        self.service_id = service_id
+
+
+class FormhubBackfill(DataQueueProcessor):
+    """
+    Sends every submission of a FormhubService to DHIS2, for forms that
+    already have submissions when they are mapped.
+
+    Submissions are paged through the Formhub data API
+    settings.BACKFILL_PAGE_SIZE records at a time and rendered and batched
+    like queued ones, only up to concurrency pages and the batches being
+    sent are held at once. Records with rejected sets are added to the
+    DataQueue as failed so the regular runs retry them.
+
+    Progress is kept in the service's BackfillCheckpoint: its offset is
+    advanced past every record whose sets DHIS2 answered for, so a backfill
+    that stopped resumes from there and only re-sends the batches that were
+    in flight, which DHIS2 imports idempotently.
+    """
+    service = None
+    page_size = None
+    # records of the service skipped before the backfill started
+    offset = 0
+    checkpoint = None
+    # index of the next record to be rendered
+    next_record = 0
+
+    def __init__(self, service, page_size=None, batch=None, concurrency=None,
+                 offset=None):
+        super(FormhubBackfill, self).__init__(
+            batch=batch, concurrency=concurrency, service_id=service.pk)
+        self.service = service
+        self.page_size = page_size or settings.BACKFILL_PAGE_SIZE
+        self.checkpoint, created = BackfillCheckpoint.objects.get_or_create(
+            service=service)
+        if offset is None:
+            # resume an unfinished backfill
+            offset = 0
+            if self.checkpoint.finished_on is None:
+                offset = self.checkpoint.offset
+        self.offset = self.next_record = offset
+        self.checkpoint.offset = offset
+        self.checkpoint.finished_on = None
+        self.checkpoint.save()
+        self.summary.update({'records': 0, 'pages': 0, 'sets': 0,
+                             'next_offset': offset, 'seconds': 0.0,
+                             'records_per_second': 0.0})
+
+    def request_page(self, offset):
+        """
+        safe to call from a worker thread, returns None on failure
+        """
+        started = time.time()
+        try:
+            return get_submission_page(self.service, offset, self.page_size)
+        except Exception:
+            return None
+        finally:
+            self.metrics.observe('fetch', time.time() - started,
+                                 [self.service.pk])
+
+    def iter_pages(self):
+        """
+        yields (offset, records) pages in order until the last one,
+        requesting up to concurrency pages ahead when running concurrently
+        """
+        offset = self.offset
+        pending = deque()
+        while True:
+            while len(pending) < self.concurrency:
+                if self.pool is None:
+                    records = self.request_page(offset)
+                else:
+                    records = self.pool.apply_async(self.request_page,
+                                                    (offset,))
+                pending.append((offset, records))
+                offset += self.page_size
+            page_offset, records = pending.popleft()
+            if isinstance(records, AsyncResult):
+                records = records.get()
+            self.summary['fetches'] += 1
+            if records is None:
+                self.summary['fetch_failed'] += 1
+                return
+            yield page_offset, records
+            if len(records) < self.page_size:
+                return
+
+    def process_record(self, record):
+        self.summary['records'] += 1
+        prerender = self.batches[0].codec.prerender
+        # hold the record open until all its sets are in a batch
+        self.retain(record)
+        for dvs in self.get_data_value_sets(self.service):
+            dvsi = DataValueSetInterface(dvs, record.data)
+            started = time.time()
+            values = dvsi.load_dict()
+            self.metrics.observe('load_dict', time.time() - started,
+                                 [self.service.pk])
+            xml = None
+            if prerender:
+                started = time.time()
+                xml = dvsi.render(values)
+                self.metrics.observe('render', time.time() - started,
+                                     [self.service.pk])
+            self.summary['sets'] += 1
+            self.add_to_batch(record, xml, values)
+        # the record is done with, only its id is kept until sent
+        record.data = None
+        self.next_record = record.pk + 1
+        self.release(record)
+
+    def apply_results(self, results):
+        super(FormhubBackfill, self).apply_results(results)
+        self.save_checkpoint()
+
+    def save_checkpoint(self):
+        """
+        advances the checkpoint to the first record not answered for yet
+        """
+        offset = self.next_record
+        if self.outstanding:
+            offset = min(self.outstanding)
+        if offset > self.checkpoint.offset:
+            self.checkpoint.offset = offset
+            BackfillCheckpoint.objects.filter(pk=self.checkpoint.pk)\
+                .update(offset=offset, modified_on=datetime.now())
+
+    def queue_record(self, record, status, message, attempts,
+                     next_attempt_on):
+        """
+        adds a record that was not sent to the DataQueue for the regular
+        runs to send
+        """
+        if record.data_id is None:
+            return
+        dq, created = DataQueue.objects.get_or_create(
+            service=self.service, data_id=record.data_id)
+        dq.processed = False
+        dq.status = status
+        dq.message = message
+        dq.attempts = attempts
+        dq.next_attempt_on = next_attempt_on
+        dq.save()
+
+    def finish_item(self, record, failures=None):
+        if not failures:
+            self.summary['processed'] += 1
+            return
+        self.summary['failed'] += 1
+        self.queue_record(record, DataQueue.STATUS_FAILED,
+                          u"\n".join(failures), 1,
+                          datetime.now() + get_retry_delay(1))
+
+    def postpone_item(self, record):
+        self.summary['postponed'] += 1
+        self.queue_record(record, DataQueue.STATUS_PENDING,
+                          u"DHIS2 is unavailable", 0,
+                          self.get_postponed_until())
+
+    def release_items(self):
+        pass
+
+    def run(self):
+        started = time.time()
+        if not self.get_data_value_sets(self.service):
+            return self.summary
+        self.start()
+        try:
+            breaker = get_dhis2_circuit_breaker()
+            for offset, records in self.iter_pages():
+                if breaker.is_open():
+                    self.summary['circuit_open'] = True
+                    break
+                self.summary['pages'] += 1
+                for i, data in enumerate(records):
+                    # the checkpoint stays at the first record not rendered
+                    if breaker.is_open():
+                        self.summary['circuit_open'] = True
+                        break
+                    self.process_record(
+                        BackfillRecord(offset + i, data, self.service.pk))
+                if self.summary['circuit_open']:
+                    break
+            for lane in range(self.concurrency):
+                self.flush(lane)
+        finally:
+            self.stop()
+            self.save_checkpoint()
+        self.summary['next_offset'] = self.checkpoint.offset
+        if not self.summary['fetch_failed'] and \
+                not self.summary['circuit_open']:
+            BackfillCheckpoint.objects.filter(pk=self.checkpoint.pk)\
+                .update(finished_on=datetime.now())
+        self.summary['seconds'] = time.time() - started
+        if self.summary['seconds']:
+            self.summary['records_per_second'] = \
+                self.summary['records'] / self.summary['seconds']
+        self.record_stats()
+        return self.summary
 
 
 def load_form_from_formhub(url):
     ENDS_WITH = u'form.json'
     if not url.endswith(ENDS_WITH):
         url = u'/'.join([url.strip('/'), ENDS_WITH])
-    http = httplib2.Http()
-    req, content = http.request(url, 'GET')
+    req, content = get_formhub_client().request(url, 'GET')
     if req.status == 200:
         try:
             return json.loads(content)
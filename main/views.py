@@ -1,18 +1,21 @@
 import json
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.db.utils import IntegrityError
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
+from django.views.decorators.csrf import csrf_exempt
 from django.utils.translation import ugettext as _
 from main.forms import (DataSetImportForm, FormhubImportForm,
                         DataValueSetForm, FHDataElementForm)
+from main.metrics import STAGES
 
 from main.models import (FormhubService, DataQueue, DataValueSet, DataElement,
                          FormDataElement, DataSet)
-from main.tasks import process_dqueue
-from main.utils import process_data_queue, basic_http_auth
+from main.tasks import schedule_process_dqueue
+from main.utils import get_metrics, process_data_queue, basic_http_auth
 
 
 def main(request):
@@ -20,21 +23,74 @@ def main(request):
     return render_to_response("index.html", context_instance=context)
 
 
-def initiate_formhub_request(request, id_string, uuid):
+def get_pushed_submission(request):
+    """
+    returns the submission Formhub POSTed as JSON, None when the request has
+    no body, raises ValueError when it is not a JSON object
+    """
+    if request.method != 'POST' or not request.body:
+        return None
+    submission = json.loads(request.body)
+    if not isinstance(submission, dict):
+        raise ValueError(u"not a JSON object")
+    return submission
+
+
+@csrf_exempt
+def initiate_formhub_request(request, id_string, uuid=None):
+    """
+    Queues a submission of the service for DHIS2. Formhub may POST the
+    submission's JSON, which is then stored with the item instead of being
+    pulled from Formhub, and its uuid may be left out of the url. Pushed
+    submissions go to DHIS2 as they are, so they need an authenticated user.
+    """
+    if request.method == 'POST' and request.body:
+        return push_formhub_submission(request, id_string, uuid)
+    return queue_formhub_submission(request, id_string, uuid)
+
+
+@basic_http_auth
+def push_formhub_submission(request, id_string, uuid=None):
+    return queue_formhub_submission(request, id_string, uuid)
+
+
+def queue_formhub_submission(request, id_string, uuid=None):
     context = RequestContext(request)
+    fs = None
     try:
-        fs = FormhubService.objects.get(id_string=id_string)
-    except FormhubService.DoesNotExist:
-        context.contents = _(u"Unknown Service")
-        context.status = False
+        submission = get_pushed_submission(request)
+    except ValueError:
+        submission = None
+        context.contents = _(u"Invalid submission")
     else:
+        if submission is not None and uuid is not None \
+                and submission.get('_uuid') != uuid:
+            context.contents = _(u"Submission uuid does not match")
+        else:
+            if uuid is None and submission is not None:
+                uuid = submission.get('_uuid')
+            if not uuid:
+                context.contents = _(u"Missing submission uuid")
+            else:
+                try:
+                    fs = FormhubService.objects.get(id_string=id_string)
+                except FormhubService.DoesNotExist:
+                    context.contents = _(u"Unknown Service")
+    context.status = False
+    if fs is not None:
         dq, created = DataQueue.objects.get_or_create(service=fs, data_id=uuid)
+        dq.payload = None
+        if submission is not None:
+            dq.payload = json.dumps(submission)
         dq.processed = False
+        dq.status = DataQueue.STATUS_PENDING
+        dq.attempts = 0
+        dq.next_attempt_on = None
         dq.save()
         context.status = context.status = True
         context.contents = _(u"OK")
         # call process queue asynchronously
-        process_dqueue.delay()
+        schedule_process_dqueue(fs)
     response = {"status": context.status, "contents": context.contents}
     if 'callback' in request.GET and request.GET.get('callback') != '':
         callback = request.GET.get('callback')
@@ -88,13 +144,52 @@ def show_formhub_forms(request):
     return  render_to_response("formhub-import.html", context_instance=context)
 
 
+def get_stage_rows(stages):
+    """
+    returns (stage, histogram) pairs of a run's stage timings in pipeline
+    order, a p50 or p99 past the last bucket is shown as unknown
+    """
+    rows = []
+    for stage in STAGES:
+        if stage in stages:
+            histogram = dict(stages[stage])
+            for key in ('p50', 'p99'):
+                if histogram[key] == float('inf'):
+                    histogram[key] = None
+            rows.append((stage, histogram))
+    return rows
+
+
 @login_required
 def process_dataqueue(request):
     context = RequestContext(request)
-    context.processed = process_data_queue()
+    try:
+        concurrency = int(request.GET.get('concurrency', 0))
+    except ValueError:
+        concurrency = 0
+    # the run's threads are started inside the web process
+    concurrency = min(concurrency, settings.DATA_QUEUE_MAX_CONCURRENCY)
+    context.summary = process_data_queue(concurrency=concurrency or None)
+    context.processed = context.summary['processed']
+    context.stages = get_stage_rows(context.summary['stages'])
+    services = dict(FormhubService.objects.filter(
+        pk__in=context.summary['services'].keys())
+        .values_list('pk', 'name'))
+    context.service_stages = [
+        (services.get(pk, pk), get_stage_rows(stages))
+        for pk, stages in sorted(context.summary['services'].items())]
     return render_to_response("process-queue.html", context_instance=context)
 
 
+@basic_http_auth
+def metrics(request):
+    """
+    queue depth, lag and throughput in the Prometheus text format
+    """
+    return HttpResponse(get_metrics(),
+                        content_type='text/plain; version=0.0.4')
+
+
 @login_required
 def create_datavalueset(request):
     context = RequestContext(request)